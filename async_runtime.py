@@ -0,0 +1,91 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+asyncio-режим бота (BOT_RUNTIME=async) на AsyncTeleBot.
+
+- getUpdates и уведомления админу идут через event loop, без потока на запрос;
+- работа с БД (register_user) выполняется в отдельном пуле потоков;
+- сообщения обычных пользователей (основной поток обновлений) обрабатываются
+  полностью асинхронно, тысячи обновлений могут быть в работе одновременно;
+- команды админа и callback'и пагинации передаются в существующие синхронные
+  хендлеры (bot.process_new_messages), поэтому все команды и пошаговые
+  диалоги (/add, /all, /view, /send_message, ...) работают без изменений.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import util
+from telebot.async_telebot import AsyncTeleBot
+
+
+user_logger = logging.getLogger("Actions")
+error_logger = logging.getLogger("Error")
+
+# Потоков для работы с БД (SQLite всё равно сериализует запись)
+DB_WORKERS = 4
+
+
+def build_async_bot(token, sync_bot, admin_id, register_user, db_executor):
+    """
+    Создаёт AsyncTeleBot с хендлерами:
+    - сообщения НЕ-админа — лог, уведомление админу, запись в БД (как echo_message);
+    - всё от админа и все callback'и — в синхронный sync_bot.
+    """
+    abot = AsyncTeleBot(token)
+
+    @abot.message_handler(func=lambda message: message.from_user.id != admin_id)
+    async def echo_message(message):
+        username = message.from_user.username or ""
+
+        user_logger.info(f"ID: {message.from_user.id} | User: @{username} | Wrote: {message.text}")
+        try:
+            await abot.send_message(admin_id, f"ID: {message.from_user.id}\nUser: @{username}\nWrote: {message.text}")
+        except:
+            pass
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(db_executor, register_user, message)
+        except Exception as e:
+            error_logger.error(f"Ошибка записи пользователя: {message.from_user.id}\nError: {e}\n", exc_info=True)
+
+    @abot.message_handler(func=lambda message: message.from_user.id == admin_id,
+                          content_types=util.content_type_media)
+    async def admin_message(message):
+        # Синхронные хендлеры сами уходят в пул потоков TeleBot — здесь только диспетчеризация
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, sync_bot.process_new_messages, [message])
+
+    @abot.callback_query_handler(func=lambda call: True)
+    async def admin_callback(call):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, sync_bot.process_new_callback_query, [call])
+
+    return abot
+
+
+async def _serve(token, sync_bot, admin_id, register_user):
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    abot = build_async_bot(token, sync_bot, admin_id, register_user, db_executor)
+    try:
+        await abot.polling(non_stop=False, timeout=60, request_timeout=90)
+    finally:
+        await abot.close_session()
+        db_executor.shutdown(wait=True)
+
+
+def run_async_bot(token, sync_bot, admin_id, register_user):
+    """
+    Запускает бота в asyncio-режиме (блокирует до остановки polling).
+    register_user(message) — синхронная функция записи пользователя в БД.
+    """
+    asyncio.run(_serve(token, sync_bot, admin_id, register_user))
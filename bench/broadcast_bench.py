@@ -0,0 +1,191 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Замер скорости массовой рассылки на заглушке Bot API (bench/fake_bot_api.py).
+
+Поднимает заглушку, импортирует bot.py или secondary.py во временной папке
+(своя БД и логи, настоящая БД не трогается), заполняет таблицу list и
+вызывает send_message_all / send_file_all так же, как это делает /send_message
+и /send_file. Печатает сообщ./с, p50/p99 задержки отправки и память.
+
+Пример:
+    python bench/broadcast_bench.py --users 5000 --rate 200 --workers 16 --latency-ms 60
+    python bench/broadcast_bench.py --bot secondary --mode file --flood-rate 0.01 --blocked-every 50
+"""
+
+import argparse
+import importlib
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from fake_bot_api import add_arguments, api_from_args, start_server
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_ADMIN = 1
+
+# Методы бота, время которых замеряется (только отправки получателям, не админу)
+TIMED_METHODS = ("send_message", "send_document", "send_photo", "send_video", "send_audio", "send_voice", "send_animation")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замер скорости рассылки на заглушке Bot API")
+    parser.add_argument("--bot", choices=("bot", "secondary"), default="bot", help="какой скрипт бота замерять")
+    parser.add_argument("--mode", choices=("message", "file", "both"), default="both", help="что рассылать")
+    parser.add_argument("--users", type=int, default=1000, help="сколько пользователей в таблице list")
+    parser.add_argument("--rate", type=float, default=100, help="BROADCAST_RATE, сообщ./с")
+    parser.add_argument("--workers", type=int, default=8, help="BROADCAST_WORKERS")
+    parser.add_argument("--processes", type=int, default=1, help="BROADCAST_PROCESSES")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="не считать пик памяти Python (tracemalloc замедляет)")
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def load_bot(args, api_url):
+    """Импортирует скрипт бота с настройками замера; текущая папка — временная."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "Admin_ID": str(BENCH_ADMIN),
+        "BROADCAST_RATE": str(args.rate),
+        "BROADCAST_WORKERS": str(args.workers),
+        "BROADCAST_PROCESSES": str(args.processes),
+    })
+    sys.path.insert(0, REPO)
+
+    import telebot
+    telebot.apihelper.API_URL = api_url
+    module = importlib.import_module(args.bot)
+    module.start_runtime()
+    return module
+
+
+def seed_users(module, count):
+    """Заполняет list пользователями с user_id 1000..1000+count."""
+    # Через пул бота: индексы list строятся по SQL-функции casefold, которой нет в голом sqlite3.connect
+    with module.db_pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM list")
+        cursor.executemany("INSERT INTO list(user_id, user, name, tag, phone) VALUES(?, ?, ?, ?, ?)",
+                           ((1000 + i, f"user{i}", f"Name {i}", "bench", "") for i in range(count)))
+        db.commit()
+
+
+def time_sends(bot, latencies):
+    """Оборачивает методы отправки: задержка каждого вызова к получателю пишется в latencies."""
+    lock = threading.Lock()
+
+    def wrap(method):
+        def timed(chat_id, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(chat_id, *args, **kwargs)
+            finally:
+                if int(chat_id) != BENCH_ADMIN:
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+        return timed
+
+    for name in TIMED_METHODS:
+        setattr(bot, name, wrap(getattr(bot, name)))
+
+
+def admin_message(**fields):
+    """Сообщение от админа, как его видит next-step хендлер."""
+    admin = SimpleNamespace(id=BENCH_ADMIN, username="admin")
+    fields.setdefault("text", None)
+    return SimpleNamespace(chat=admin, from_user=admin, message_id=1, **fields)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def run_case(name, module, send, message, users, api):
+    latencies = []
+    time_sends(module.bot, latencies)
+    calls_before = sum(api.calls.values())
+    errors_before = dict(api.errors)
+
+    started = time.perf_counter()
+    send(message)
+    elapsed = time.perf_counter() - started
+
+    # Обёртки снимаем, чтобы следующий случай не мерил двойную задержку
+    for method in TIMED_METHODS:
+        module.bot.__dict__.pop(method, None)
+
+    ms = [value * 1000 for value in latencies]
+    print(f"\n== {name}: {users} получателей ==")
+    print(f"Время:            {elapsed:.2f} с")
+    print(f"Скорость:         {users / elapsed:.1f} сообщ./с")
+    if ms:
+        print(f"Задержка p50/p99: {percentile(ms, 50):.1f} / {percentile(ms, 99):.1f} мс (вызовов: {len(ms)})")
+    else:
+        print("Задержка p50/p99: — (отправки шли в дочерних процессах)")
+    print(f"Запросов к API:   {sum(api.calls.values()) - calls_before}, "
+          f"429: {api.errors.get(429, 0) - errors_before.get(429, 0)}, "
+          f"403: {api.errors.get(403, 0) - errors_before.get(403, 0)}")
+
+
+def main():
+    args = parse_args()
+    api = api_from_args(args)
+    server, api_url = start_server(api)
+
+    workdir = tempfile.mkdtemp(prefix="broadcast_bench_")
+    os.chdir(workdir)
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    module = load_bot(args, api_url)
+    seed_users(module, args.users)
+    print(f"Бот: {args.bot}.py, БД: {os.path.join(workdir, module.DB_PATH)}")
+    print(f"Заглушка: задержка {args.latency_ms}+{args.jitter_ms} мс, 429: {args.flood_rate:.1%}, "
+          f"лимит: {args.limit or '—'}/с, заблокировали: {'каждый ' + str(args.blocked_every) if args.blocked_every else '—'}")
+    print(f"Рассылка: rate={args.rate}, workers={args.workers}, processes={args.processes}")
+
+    if args.mode in ("message", "both"):
+        run_case("send_message_all", module, module.send_message_all,
+                 admin_message(text="Бенчмарк рассылки"), args.users, api)
+        if args.blocked_every:
+            # Недоступные помечены — следующая рассылка их пропустит, возвращаем как было
+            seed_users(module, args.users)
+
+    if args.mode in ("file", "both"):
+        run_case("send_file_all", module, module.send_file_all,
+                 admin_message(document=SimpleNamespace(file_id="BQACAgIAAxkBAAIBenchFileId")), args.users, api)
+
+    print("\n== Память ==")
+    if not args.no_tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"tracemalloc: сейчас {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ")
+    # ru_maxrss в Linux — КБ, в macOS — байты
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"ru_maxrss:   {maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024):.1f} МБ")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Локальная заглушка Telegram Bot API для замеров рассылки (без реального Telegram).
+
+Отвечает на методы, которыми пользуется бот: sendMessage, sendDocument (и другие
+send*), editMessageText, answerCallbackQuery, getUpdates, sendChatAction, getMe.
+Умеет:
+- задержку ответа (--latency-ms, --jitter-ms);
+- ответы 429 Too Many Requests — случайно (--flood-rate) и при превышении
+  лимита сообщений в секунду (--limit), с retry_after (--retry-after);
+- 403 «bot was blocked by the user» для части получателей (--blocked-every N:
+  каждый user_id, кратный N).
+
+Запуск отдельно:
+    python bench/fake_bot_api.py --port 8081 --latency-ms 40 --limit 30
+и в боте: telebot.apihelper.API_URL = "http://127.0.0.1:8081/bot{0}/{1}"
+"""
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBotAPI:
+    """Состояние и настройки заглушки (общие для всех потоков сервера)."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, flood_rate=0.0, limit=0, retry_after=1, blocked_every=0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.flood_rate = flood_rate
+        self.limit = limit
+        self.retry_after = retry_after
+        self.blocked_every = blocked_every
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.window = (0, 0)  # (секунда, отправок в ней) для --limit
+        self.calls = {}
+        self.errors = {429: 0, 403: 0}
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def over_limit(self):
+        """Скользящее окно в 1 секунду для эмуляции общего лимита Telegram."""
+        if not self.limit:
+            return False
+        with self.lock:
+            second = int(time.time())
+            current, used = self.window
+            if current != second:
+                current, used = second, 0
+            used += 1
+            self.window = (current, used)
+            return used > self.limit
+
+    def error(self, code, description, retry_after=None):
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            body["parameters"] = {"retry_after": retry_after}
+        return code, body
+
+    def message(self, chat_id, **extra):
+        result = {"message_id": next(self.message_ids), "date": int(time.time()),
+                  "chat": {"id": chat_id, "type": "private"}}
+        result.update(extra)
+        return 200, {"ok": True, "result": result}
+
+    def handle(self, method, params):
+        """(HTTP-код, JSON-ответ) для вызова method с параметрами params."""
+        self.count(method)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+        if method == "getUpdates":
+            # Новых обновлений нет: имитируем long polling, но недолго
+            time.sleep(min(float(params.get("timeout", 0) or 0), 1))
+            return 200, {"ok": True, "result": []}
+        if method == "answerCallbackQuery":
+            return 200, {"ok": True, "result": True}
+
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        if method.startswith("send") or method == "editMessageText":
+            if self.over_limit() or (self.flood_rate and random.random() < self.flood_rate):
+                return self.error(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        if method.startswith("send") and self.blocked_every and chat_id % self.blocked_every == 0:
+            return self.error(403, "Forbidden: bot was blocked by the user")
+
+        if method == "sendChatAction":
+            return 200, {"ok": True, "result": True}
+        if method == "sendMessage":
+            return self.message(chat_id, text=params.get("text", ""))
+        if method == "editMessageText":
+            return self.message(chat_id, text=params.get("text", ""))
+        if method.startswith("send"):
+            kind = method[4:].lower()
+            file_id = params.get(kind) if isinstance(params.get(kind), str) else f"fake-{kind}-{time.time_ns()}"
+            media = {"file_id": file_id, "file_unique_id": file_id[-16:]}
+            return self.message(chat_id, **{kind: [media] if kind == "photo" else media})
+        return self.error(404, f"Not Found: method {method}")
+
+
+def parse_params(handler):
+    """Параметры запроса: query string + тело (urlencoded, multipart или JSON)."""
+    url = urllib.parse.urlsplit(handler.path)
+    params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length) if length else b""
+    content_type = handler.headers.get("Content-Type", "")
+
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+    elif content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = b"<upload>"
+            else:
+                params[name] = part.get_content().strip() if part.get_content_maintype() == "text" else part.get_payload(decode=True)
+    elif content_type.startswith("application/json") and body:
+        params.update(json.loads(body))
+    return url.path.rsplit("/", 1)[-1], params
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def _serve(self):
+            method, params = parse_params(self)
+            code, body = api.handle(method, params)
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _serve
+        do_POST = _serve
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class FakeServer(ThreadingHTTPServer):
+    # Очередь listen() по умолчанию — 5: при десятках потоков рассылки лишние
+    # соединения ждали бы повтора SYN (~1 с) и портили p99
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def start_server(api, host="127.0.0.1", port=0):
+    """Запускает сервер в фоне. Возвращает (server, base_url) — base_url для apihelper.API_URL."""
+    server = FakeServer((host, port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/bot{{0}}/{{1}}"
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=40, help="задержка ответа, мс")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="случайная добавка к задержке, мс")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля случайных ответов 429 (0..1)")
+    parser.add_argument("--limit", type=int, default=0, help="лимит отправок в секунду, сверх — 429 (0 — без лимита)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--blocked-every", type=int, default=0, help="403 для каждого user_id, кратного N (0 — нет)")
+
+
+def api_from_args(args):
+    return FakeBotAPI(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, flood_rate=args.flood_rate,
+                      limit=args.limit, retry_after=args.retry_after, blocked_every=args.blocked_every)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API для замеров")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_server(api_from_args(args), args.host, args.port)
+    print(f"Fake Bot API: {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,161 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Замер поиска /view (фильтр по полю + первая страница) на большой таблице list.
+
+Импортирует bot.py или secondary.py во временной папке, заполняет list
+(по умолчанию 1 000 000 строк) и меряет create_pagination_session +
+fetch_page_rows для случайных значений в другом регистре — сначала без
+индексов *_fold (полный проход), затем с индексами из ensure_db.
+Тег ищется через tags/user_tags по их ключам, а не по индексу list —
+его сравнивать не с чем, он замеряется один раз, отдельной строкой.
+
+Пример:
+    python bench/search_bench.py --rows 1000000 --queries 50
+    python bench/search_bench.py --bot secondary --fields user email
+"""
+
+import argparse
+import importlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Поля с индексом idx_list_*_fold — для них замер «без индекса / с индексом»
+FIELDS = {
+    "bot": ("user", "name"),
+    "secondary": ("user", "name", "email", "instagram", "tiktok"),
+}
+TAG_FIELD = "tag"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замер поиска /view на большой таблице")
+    parser.add_argument("--bot", choices=("bot", "secondary"), default="bot", help="какой скрипт бота замерять")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="сколько строк в таблице list")
+    parser.add_argument("--queries", type=int, default=50, help="запросов на каждое поле и режим")
+    parser.add_argument("--fields", nargs="*", help="какие поля замерять (по умолчанию — все индексируемые и tag)")
+    return parser.parse_args()
+
+
+def load_bot(name):
+    """Импортирует скрипт бота; текущая папка — временная (своя БД и логи)."""
+    os.environ.update({"TELEGRAM_TOKEN": "123456:BENCH", "Admin_ID": "1"})
+    sys.path.insert(0, REPO)
+    module = importlib.import_module(name)
+    module.ensure_db()
+    return module
+
+
+def row_values(i, fields):
+    """Значения полей строки i: повторяющиеся, чтобы у фильтра было несколько совпадений."""
+    values = {
+        "user": f"@User{i}",
+        "name": f"Name{i % 200000}",
+        "tag": f"Tag{i % 500}",
+        "email": f"mail{i % 300000}@Example.com",
+        "instagram": f"Insta{i % 300000}",
+        "tiktok": f"Tok{i % 300000}",
+    }
+    return [values[field] for field in fields]
+
+
+def seed(module, rows, fields):
+    started = time.perf_counter()
+    columns = ", ".join(("user_id",) + fields)
+    placeholders = ", ".join("?" * (len(fields) + 1))
+    with module.db_pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM list")
+        cursor.executemany(f"INSERT INTO list({columns}) VALUES({placeholders})",
+                           ((10_000_000 + i, *row_values(i, fields)) for i in range(rows)))
+        db.commit()
+    print(f"Заполнено {rows} строк за {time.perf_counter() - started:.1f} с")
+
+
+def drop_indexes(module, fields):
+    with module.db_pool.connection() as db:
+        for field in fields:
+            db.execute(f"DROP INDEX IF EXISTS idx_list_{field}_fold")
+        # Миграции повторяемы: после сброса версии ensure_db построит индексы заново
+        db.execute("PRAGMA user_version = 0")
+        db.commit()
+
+
+def query_plan(module, field):
+    """План запроса первой страницы — того же, что выполняет ListRepository."""
+    _, sql = module.repo._sql_for("page", field)
+    with module.db_pool.connection() as db:
+        rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", ("x", 0, module.PAGE_SIZE, 0)).fetchall()
+    return "; ".join(row[-1] for row in rows)
+
+
+def measure(module, field, rows, queries):
+    """Задержки (мс) поиска: подсчёт совпадений + первая страница, значение в другом регистре."""
+    fields = FIELDS["secondary"] + (TAG_FIELD,)
+    latencies = []
+    found = 0
+    for _ in range(queries):
+        value = row_values(random.randrange(rows), fields)[fields.index(field)].swapcase()
+        started = time.perf_counter()
+        token = module.create_pagination_session(where=field, where_val=value)
+        page, _ = module.fetch_page_rows(token, 0)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found += bool(page)
+        module.PAGINATION_SESSIONS.pop(token, None)
+    return latencies, found
+
+
+def report(label, latencies, found, queries):
+    p99 = statistics.quantiles(latencies, n=100, method="inclusive")[98] if len(latencies) > 1 else latencies[0]
+    print(f"  {label:<14} p50 {statistics.median(latencies):8.2f} мс   p99 {p99:8.2f} мс   найдено: {found}/{queries}")
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="search_bench_")
+    os.chdir(workdir)
+
+    module = load_bot(args.bot)
+    selected = args.fields or FIELDS[args.bot] + (TAG_FIELD,)
+    fields = tuple(field for field in selected if field != TAG_FIELD)
+    print(f"Бот: {args.bot}.py, БД: {os.path.join(workdir, module.DB_PATH)}")
+    seed(module, args.rows, FIELDS[args.bot] + (TAG_FIELD,))
+
+    results = {}
+    drop_indexes(module, FIELDS[args.bot])
+    for field in fields:
+        results[(field, False)] = measure(module, field, args.rows, args.queries)
+
+    started = time.perf_counter()
+    module.ensure_db()
+    print(f"Индексы *_fold построены за {time.perf_counter() - started:.1f} с")
+    for field in fields:
+        results[(field, True)] = measure(module, field, args.rows, args.queries)
+
+    for field in fields:
+        print(f"\n== {field} ==  план: {query_plan(module, field)}")
+        report("без индекса:", *results[(field, False)], args.queries)
+        report("с индексом:", *results[(field, True)], args.queries)
+
+    if TAG_FIELD in selected:
+        # Ключи tags/user_tags и UNIQUE(user_id) у list не сбрасываются — сравнивать не с чем
+        print(f"\n== {TAG_FIELD} ==  план: {query_plan(module, TAG_FIELD)}")
+        report("tags/user_tags:", *measure(module, TAG_FIELD, args.rows, args.queries), args.queries)
+
+
+if __name__ == "__main__":
+    main()
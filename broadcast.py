@@ -0,0 +1,967 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Движок массовой рассылки (общий для bot.py и secondary.py).
+
+Отправка идёт через пул потоков, а общий темп держит глобальный
+token bucket (Telegram допускает ~30 сообщений в секунду на бота).
+При ответе 429 (Too Many Requests) весь исходящий поток ставится на паузу
+на retry_after секунд, получатель возвращается в очередь, а темп снижается
+и потом плавно восстанавливается.
+Каждая рассылка хранится в БД как задание с курсором по list.user_id,
+поэтому после падения её можно продолжить с последней контрольной точки.
+Чаты, которые заблокировали бота / удалены / не найдены, помечаются в
+list.status и в следующие рассылки не попадают (пока их не перепроверят).
+Очень большие рассылки можно разбить по диапазонам user_id на несколько
+процессов (шардов) с общим бюджетом скорости в разделяемой памяти.
+"""
+
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from db import connect, add_columns
+
+
+error_logger = logging.getLogger("Error")
+
+# Значения по умолчанию (переопределяются через .env в bot.py / secondary.py)
+DEFAULT_RATE = 30
+DEFAULT_WORKERS = 8
+
+# Как часто (в обработанных получателях) сохранять прогресс задания в БД
+CHECKPOINT_EVERY = 200
+
+# Размер порции при чтении получателей из БД (keyset: WHERE user_id > ? ... LIMIT n)
+RECIPIENT_CHUNK = 1000
+
+# Как запускать процессы-шарды: spawn — новый интерпретатор без унаследованных потоков и блокировок.
+# Скрипт бота в шарде импортируется заново как __mp_main__, поэтому его тяжёлая инициализация
+# (миграции, буферы записи, загрузка known_users) вынесена в start_runtime() и там не выполняется
+SHARD_START_METHOD = "spawn"
+
+# Куда шард пишет ошибки, если логирование в нём ещё не настроено (как error_handler в bot.py)
+SHARD_ERROR_LOG = "logs/Error.log"
+
+# Получатели сегмента: связи тега (user_tags) + их строки list (для status)
+SEGMENT_SOURCE = "user_tags JOIN list ON list.user_id = user_tags.user_id"
+
+# Перепроверка недоступного чата: интервал удваивается после каждой неудачи, не больше стольких раз
+# (при STATUS_REPROBE_INTERVAL сутки — не реже раза в 32 дня)
+REPROBE_MAX_DOUBLINGS = 5
+
+# Не чаще чем раз в сколько секунд редактировать сообщение с прогрессом рассылки
+PROGRESS_INTERVAL = 5
+
+# Сколько раз пробовать отправку одному получателю при 429
+MAX_ATTEMPTS = 5
+
+# Адаптация темпа: после 429 скорость умножается на THROTTLE_FACTOR (но не ниже MIN_RATE),
+# после каждой успешной отправки растёт на RECOVER_STEP от целевой, пока не вернётся к ней
+THROTTLE_FACTOR = 0.7
+MIN_RATE = 1
+RECOVER_STEP = 0.002
+
+
+# Статусы «мёртвых» получателей в list.status (NULL — активен)
+STATUS_BLOCKED = "blocked"
+STATUS_DEACTIVATED = "deactivated"
+STATUS_NOT_FOUND = "not_found"
+
+
+def retry_after(e):
+    """Для ошибки 429 (Too Many Requests) — сколько секунд ждать, для остальных — None."""
+    if getattr(e, "error_code", None) != 429:
+        return None
+    params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+def recipient_status(e):
+    """По ошибке API определяет, что чат недоступен насовсем: blocked / deactivated / not_found, иначе None."""
+    if getattr(e, "error_code", None) not in (400, 403):
+        return None
+    description = (getattr(e, "description", None) or str(e)).lower()
+    if "bot was blocked by the user" in description:
+        return STATUS_BLOCKED
+    if "user is deactivated" in description:
+        return STATUS_DEACTIVATED
+    if "chat not found" in description:
+        return STATUS_NOT_FOUND
+    return None
+
+
+def log_send_error(user_id, e):
+    """Логирование ошибки отправки по умолчанию (если свой on_error не передан)."""
+    error_logger.error(f"Ошибка рассылки для: {user_id}\nError: {e}\n", exc_info=True)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket с паузой по flood control.
+    rate  — сколько токенов добавляется в секунду (целевая скорость).
+    burst — допустимый всплеск (по умолчанию 1: ровный темп без пачек).
+    Текущая скорость (self.rate) снижается после 429 и восстанавливается до target.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.target = float(rate)
+        self.rate = self.target
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует вызывающий поток, пока не появится свободный токен (и не кончится пауза)."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    start = max(self.updated, self.paused_until)
+                    self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Останавливает выдачу токенов на seconds (retry_after из ответа 429) и снижает темп.
+        Несколько 429 из одной пачки дают одно снижение, а не каскад.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.rate = max(MIN_RATE, self.rate * THROTTLE_FACTOR)
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            return self.rate
+
+    def success(self):
+        """Успешная отправка — понемногу возвращаем темп к целевому."""
+        if self.rate < self.target:
+            with self.lock:
+                self.rate = min(self.target, self.rate + self.target * RECOVER_STEP)
+
+
+class BroadcastStats:
+    """
+    Счётчики одной рассылки: sent, failed, blocked (недоступные чаты, входят в failed),
+    retried (повторы после 429) и скорость (сообщ./с).
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def add(self, ok):
+        with self.lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def add_blocked(self):
+        with self.lock:
+            self.blocked += 1
+
+    def add_retry(self):
+        with self.lock:
+            self.retried += 1
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        end = self.finished or time.monotonic()
+        return max(end - self.started, 1e-9)
+
+    @property
+    def rate(self):
+        """Достигнутая скорость: успешно отправленных сообщений в секунду."""
+        return self.sent / self.elapsed
+
+
+class Broadcaster:
+    """
+    Пул потоков для рассылки с общим ограничением скорости.
+    Один экземпляр создаётся на бота, поэтому лимит действует
+    сразу на все рассылки, запущенные параллельно.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, bucket=None):
+        # bucket можно передать свой (SharedTokenBucket — общий лимит для нескольких процессов)
+        self.bucket = bucket or TokenBucket(rate)
+        self.workers = max(1, int(workers))
+
+    def flood_wait(self, delay):
+        """Пауза всего исходящего потока после 429."""
+        rate = self.bucket.pause(delay)
+        error_logger.error(f"Flood control (429): пауза {delay:.0f} c, темп снижен до {rate:.1f} сообщ./с")
+
+    def send(self, call):
+        """
+        Одиночная отправка через общий лимит (отправка по ID).
+        call — функция без аргументов, например lambda: bot.send_message(...).
+        При 429 ждёт retry_after и повторяет (до MAX_ATTEMPTS раз), остальные ошибки пробрасывает.
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.bucket.acquire()
+            try:
+                result = call()
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == MAX_ATTEMPTS:
+                    raise
+                self.flood_wait(delay)
+                continue
+            self.bucket.success()
+            return result
+
+    def run(self, user_ids, send_one, on_error=None, observers=(), stats=None):
+        """
+        Отправляет всем user_ids через send_one(user_id).
+        Исключение из send_one считается неудачной отправкой и передаётся в on_error(user_id, e).
+        user_ids может быть любым итерируемым (в т.ч. генератором).
+        observers — объекты с методами dispatched(user_id) и completed(user_id, ok)
+        (например, JobCheckpoint).
+        stats — свой BroadcastStats, если счётчики нужно читать во время рассылки.
+        Возвращает BroadcastStats.
+        """
+        stats = stats or BroadcastStats()
+        # Ограниченная очередь: не держим в памяти больше, чем успевают разобрать потоки
+        tasks = queue.Queue(maxsize=self.workers * 2)
+        # Получатели, отложенные из-за 429, — разбираются раньше новых
+        retries = queue.SimpleQueue()
+        attempts = {}
+
+        def worker():
+            while True:
+                try:
+                    user_id = retries.get_nowait()
+                except queue.Empty:
+                    user_id = tasks.get()
+                if user_id is None:
+                    return
+                self.bucket.acquire()
+                try:
+                    send_one(user_id)
+                    ok = True
+                    self.bucket.success()
+                except Exception as e:
+                    delay = retry_after(e)
+                    attempt = attempts.get(user_id, 1)
+                    if delay is not None and attempt < MAX_ATTEMPTS:
+                        attempts[user_id] = attempt + 1
+                        stats.add_retry()
+                        self.flood_wait(delay)
+                        retries.put(user_id)
+                        continue
+                    ok = False
+                    try:
+                        (on_error or log_send_error)(user_id, e)
+                    except Exception as error:
+                        error_logger.error(f"Ошибка обработчика on_error рассылки для: {user_id}\nError: {error}\n", exc_info=True)
+                attempts.pop(user_id, None)
+                stats.add(ok)
+                notify("completed", user_id, ok)
+
+        def notify(event, *args):
+            # Ошибка наблюдателя (например, SQLite занята дольше busy_timeout при сохранении
+            # контрольной точки) не должна убивать поток: иначе очередь перестанет разбираться
+            for observer in observers:
+                try:
+                    getattr(observer, event)(*args)
+                except Exception as e:
+                    error_logger.error(f"Ошибка наблюдателя рассылки ({type(observer).__name__}.{event}) для: {args[0]}\nError: {e}\n", exc_info=True)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for user_id in user_ids:
+                notify("dispatched", user_id)
+                tasks.put(user_id)
+        finally:
+            # Даже если user_ids упал (ошибка чтения из БД), потоки должны завершиться
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+        stats.finish()
+        return stats
+
+
+# -----------------------
+# Задания рассылки (возобновляемые)
+# -----------------------
+# broadcast_jobs: одно задание = одна рассылка.
+#   kind    — "message" (payload — текст) или тип медиа: "document", "photo", ... (payload — file_id)
+#   chat_id — куда отчитаться о результате (чат админа)
+#   cursor  — наибольший user_id, до которого включительно все получатели обработаны
+#   status  — "running" пока рассылка не завершена, затем "done"
+#   parent_id, upper — для шардов: родительское задание и верхняя граница user_id (включительно)
+#   segment — tags.id, если рассылка только по сегменту (NULL — всем активным)
+JOBS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        payload TEXT,
+        chat_id INTEGER,
+        cursor INTEGER,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running',
+        created REAL,
+        updated REAL,
+        parent_id INTEGER,
+        upper INTEGER,
+        segment INTEGER
+    );
+"""
+
+JOB_COLUMNS = ("id", "kind", "payload", "chat_id", "cursor", "sent", "failed", "status", "parent_id", "upper", "segment")
+
+
+def ensure_jobs_table(cursor):
+    """Создаёт таблицу broadcast_jobs (миграция ensure_db) и добавляет недостающие колонки."""
+    cursor.execute(JOBS_SCHEMA)
+
+    add_columns(cursor, "broadcast_jobs", {"parent_id": "INTEGER", "upper": "INTEGER", "segment": "INTEGER"})
+
+
+def create_job(db_path, kind, payload, chat_id, cursor=None, parent_id=None, upper=None, segment=None):
+    """Регистрирует новое задание рассылки (segment — tags.id сегмента или None) и возвращает его в виде dict."""
+    with connect(db_path) as db:
+        job = _insert_job(db.cursor(), kind, payload, chat_id, cursor, parent_id, upper, segment)
+        db.commit()
+    return job
+
+
+def _insert_job(db_cursor, kind, payload, chat_id, cursor, parent_id, upper, segment):
+    """INSERT задания в уже открытой транзакции (коммитит вызывающий)."""
+    now = time.time()
+    db_cursor.execute(
+        "INSERT INTO broadcast_jobs(kind, payload, chat_id, cursor, parent_id, upper, segment, created, updated) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (kind, payload, chat_id, cursor, parent_id, upper, segment, now, now)
+    )
+    return {"id": db_cursor.lastrowid, "kind": kind, "payload": payload, "chat_id": chat_id, "cursor": cursor,
+            "sent": 0, "failed": 0, "status": "running", "parent_id": parent_id, "upper": upper, "segment": segment}
+
+
+def unfinished_jobs(db_path):
+    """Список незавершённых заданий верхнего уровня (status = 'running', без шардов), старые — первыми."""
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM broadcast_jobs "
+                       f"WHERE status = 'running' AND parent_id IS NULL ORDER BY id ASC")
+        return [dict(zip(JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def job_shards(db_path, job_id):
+    """Шарды (дочерние задания) рассылки job_id по возрастанию диапазона."""
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM broadcast_jobs WHERE parent_id = ? ORDER BY id ASC", (job_id,))
+        return [dict(zip(JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def job_sender(bot, job):
+    """
+    send_one(user_id) для задания: текст (kind "message", с префиксом «Сообщение: »)
+    или медиа по file_id (kind — document / photo / video / ..., метод bot.send_<kind>).
+    """
+    if job["kind"] == "message":
+        return lambda user_id: bot.send_message(f"{user_id}", f"Сообщение: {job['payload']}")
+    send = getattr(bot, f"send_{job['kind']}")
+    return lambda user_id: send(user_id, job["payload"])
+
+
+def iter_user_ids(db_path, condition, params=(), after=None, chunk=RECIPIENT_CHUNK, source="list", key="user_id"):
+    """
+    Генератор user_id из list (или source) по возрастанию, порциями по chunk строк:
+        SELECT key FROM source WHERE <condition> AND key > ? ORDER BY key LIMIT ?
+    Каждая порция — отдельный короткий запрос, так что память не растёт с размером
+    таблицы, а снимок чтения не держится всю рассылку.
+    after — курсор (начать строго после него), None — с начала.
+    """
+    while True:
+        with connect(db_path) as db:
+            cursor = db.cursor()
+            if after is None:
+                cursor.execute(f"SELECT {key} FROM {source} WHERE {condition} ORDER BY {key} ASC LIMIT ?",
+                               (*params, chunk))
+            else:
+                cursor.execute(f"SELECT {key} FROM {source} WHERE {condition} AND {key} > ? ORDER BY {key} ASC LIMIT ?",
+                               (*params, after, chunk))
+            rows = cursor.fetchall()
+
+        for row in rows:
+            yield row[0]
+
+        if len(rows) < chunk:
+            return
+        after = rows[-1][0]
+
+
+def iter_job_recipients(db_path, after=None, upper=None, segment=None):
+    """
+    Активные получатели (status IS NULL) строго после курсора after и не выше upper.
+    Запрос идёт по индексу idx_list_status (status, user_id), у сегмента — по user_tags.
+    """
+    source, key, condition, params = _recipients_range(None, upper, segment)
+    return iter_user_ids(db_path, condition, params, after=after, source=source, key=key)
+
+
+class JobCheckpoint:
+    """
+    Наблюдатель для Broadcaster.run: ведёт курсор задания и пачками пишет его в БД.
+    Потоки завершают отправки не по порядку, поэтому курсор сдвигается только
+    по непрерывному префиксу обработанных user_id (в порядке выдачи).
+    """
+
+    def __init__(self, db_path, job, every=CHECKPOINT_EVERY):
+        self.db_path = db_path
+        self.job_id = job["id"]
+        self.cursor = job["cursor"]
+        self.sent = job["sent"]
+        self.failed = job["failed"]
+        self.every = max(1, every)
+        self.stats = None
+        self.blocked = 0
+        self.inflight = collections.deque()
+        self.done = {}
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+    def dispatched(self, user_id):
+        with self.lock:
+            self.inflight.append(user_id)
+
+    def completed(self, user_id, ok):
+        with self.lock:
+            self.done[user_id] = ok
+            while self.inflight and self.inflight[0] in self.done:
+                self.cursor = self.inflight.popleft()
+                if self.done.pop(self.cursor):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self.unsaved += 1
+            if self.unsaved >= self.every:
+                self._save("running")
+
+    def finish(self):
+        """Финальная запись: задание помечается выполненным."""
+        with self.lock:
+            self._save("done")
+
+    def _save(self, status):
+        with connect(self.db_path) as db:
+            cursor = db.cursor()
+            cursor.execute(
+                "UPDATE broadcast_jobs SET cursor = ?, sent = ?, failed = ?, status = ?, updated = ? WHERE id = ?",
+                (self.cursor, self.sent, self.failed, status, time.time(), self.job_id)
+            )
+            db.commit()
+        self.unsaved = 0
+
+
+def _recipients_range(after, upper, segment=None):
+    """
+    (source, key, условие, параметры) для диапазона (after, upper] среди активных получателей.
+    Сегмент читается от user_tags по PRIMARY KEY (tag_id, user_id) — только его участники,
+    по порядку user_id, — а status проверяется поиском в list по уникальному user_id.
+    """
+    if segment is None:
+        source, key, condition, params = "list", "user_id", "status IS NULL", []
+    else:
+        source, key = SEGMENT_SOURCE, "user_tags.user_id"
+        condition, params = "user_tags.tag_id = ? AND list.status IS NULL", [segment]
+    if after is not None:
+        condition += f" AND {key} > ?"
+        params.append(after)
+    if upper is not None:
+        condition += f" AND {key} <= ?"
+        params.append(upper)
+    return source, key, condition, params
+
+
+def count_job_recipients(db_path, after=None, upper=None, segment=None):
+    """Сколько активных получателей осталось в диапазоне задания (для ETA в прогрессе)."""
+    source, key, condition, params = _recipients_range(after, upper, segment)
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM {source} WHERE {condition}", params)
+        return cursor.fetchone()[0] or 0
+
+
+def run_job(broadcaster, db_path, job, send_one, on_error=None, progress=None, stats=None):
+    """
+    Выполняет (или продолжает) задание: рассылает всем с user_id > job["cursor"]
+    (и не выше job["upper"], если это шард).
+    Недоступные чаты помечаются в list.status и в on_error не передаются.
+    progress — ProgressReporter для живого сообщения о ходе рассылки (необязательно).
+    stats — общие счётчики (SharedStats у шардов), по умолчанию свои.
+    Возвращает JobCheckpoint с итоговыми sent / failed (включая прошлые запуски),
+    blocked (помечено в этом запуске) и stats текущего запуска (скорость и т.п.).
+    """
+    checkpoint = JobCheckpoint(db_path, job)
+    tracker = StatusTracker(db_path)
+    stats = stats or BroadcastStats()
+    upper = job.get("upper")
+    segment = job.get("segment")
+
+    def handle_error(user_id, e):
+        if tracker.record(user_id, e):
+            stats.add_blocked()
+        else:
+            (on_error or log_send_error)(user_id, e)
+
+    if progress:
+        progress.start(stats, count_job_recipients(db_path, job["cursor"], upper, segment))
+    try:
+        user_ids = iter_job_recipients(db_path, job["cursor"], upper, segment)
+        checkpoint.stats = broadcaster.run(user_ids, send_one, on_error=handle_error,
+                                           observers=(checkpoint,), stats=stats)
+    finally:
+        if progress:
+            progress.stop()
+    tracker.flush()
+    checkpoint.blocked = tracker.marked
+    checkpoint.finish()
+    return checkpoint
+
+
+# -----------------------
+# Шардированная рассылка (несколько процессов)
+# -----------------------
+class SharedTokenBucket:
+    """
+    Ограничитель скорости в разделяемой памяти: один бюджет на все процессы.
+    Каждый acquire резервирует ближайший свободный слот (раз в 1/rate секунд).
+    Интерфейс как у TokenBucket (acquire / pause / success), поэтому подходит в Broadcaster.
+    """
+
+    def __init__(self, rate, ctx=None):
+        ctx = ctx or shard_context()
+        self.target = float(rate)
+        self._rate = ctx.Value("d", self.target, lock=False)
+        self._next = ctx.Value("d", 0.0, lock=False)
+        self._paused_until = ctx.Value("d", 0.0, lock=False)
+        self._lock = ctx.Lock()
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                slot = max(now, self._next.value, self._paused_until.value)
+                self._next.value = slot + 1 / self._rate.value
+            if slot > now:
+                time.sleep(slot - now)
+            # Слот мог попасть под паузу, выставленную уже после резервирования
+            if time.time() >= self._paused_until.value:
+                return
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.time()
+            if now >= self._paused_until.value:
+                self._rate.value = max(MIN_RATE, self._rate.value * THROTTLE_FACTOR)
+            self._paused_until.value = max(self._paused_until.value, now + seconds)
+            return self._rate.value
+
+    def success(self):
+        if self._rate.value < self.target:
+            with self._lock:
+                self._rate.value = min(self.target, self._rate.value + self.target * RECOVER_STEP)
+
+
+class SharedStats:
+    """
+    Счётчики рассылки в разделяемой памяти: шарды пишут, родитель читает (прогресс, итог).
+    Интерфейс как у BroadcastStats; завершение фиксирует родитель через close(),
+    а finish() шардов ничего не делает, чтобы скорость считалась по всей рассылке.
+    """
+
+    def __init__(self, ctx=None):
+        ctx = ctx or shard_context()
+        self._counters = ctx.Array("q", 4)  # sent, failed, blocked, retried
+        self.started = time.time()
+        self.finished = None
+
+    def _inc(self, index):
+        with self._counters.get_lock():
+            self._counters[index] += 1
+
+    def add(self, ok):
+        self._inc(0 if ok else 1)
+
+    def add_blocked(self):
+        self._inc(2)
+
+    def add_retry(self):
+        self._inc(3)
+
+    sent = property(lambda self: self._counters[0])
+    failed = property(lambda self: self._counters[1])
+    blocked = property(lambda self: self._counters[2])
+    retried = property(lambda self: self._counters[3])
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        end = self.finished or time.time()
+        return max(end - self.started, 1e-9)
+
+    @property
+    def rate(self):
+        return self.sent / self.elapsed
+
+
+def create_shard_jobs(db_path, job, shards):
+    """
+    Делит оставшихся получателей задания на shards диапазонов user_id примерно
+    поровну и создаёт по дочернему заданию на каждый диапазон.
+    Все шарды создаются одной транзакцией: при падении посередине не останется
+    неполного набора, который job_shards принял бы за весь (без верхнего диапазона).
+    """
+    total = count_job_recipients(db_path, job["cursor"], segment=job.get("segment"))
+    step = max(1, -(-total // shards))
+    source, key, condition, params = _recipients_range(job["cursor"], None, job.get("segment"))
+
+    bounds = []
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        for k in range(1, shards):
+            cursor.execute(f"SELECT {key} FROM {source} WHERE {condition} ORDER BY {key} ASC LIMIT 1 OFFSET ?",
+                           (*params, k * step - 1))
+            row = cursor.fetchone()
+            if not row:
+                break
+            bounds.append(row[0])
+    bounds.append(None)
+
+    children = []
+    lower = job["cursor"]
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        for upper in bounds:
+            children.append(_insert_job(cursor, job["kind"], job["payload"], job["chat_id"],
+                                        lower, job["id"], upper, job.get("segment")))
+            lower = upper
+        db.commit()
+    return children
+
+
+def shard_context():
+    """
+    Контекст multiprocessing для шардов. Не fork: родитель многопоточный (polling,
+    write-behind, прогресс), и дочерний процесс мог бы унаследовать чужую занятую
+    блокировку (пул соединений, logging) и зависнуть.
+    """
+    return multiprocessing.get_context(SHARD_START_METHOD)
+
+
+def _setup_shard_logging():
+    """Логи ошибок шарда — как у бота (logs/Error.log и консоль), если их ещё никто не настроил."""
+    if error_logger.handlers:
+        return
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handlers = [logging.StreamHandler()]
+    if os.path.isdir(os.path.dirname(SHARD_ERROR_LOG)):
+        handlers.append(logging.FileHandler(SHARD_ERROR_LOG))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        error_logger.addHandler(handler)
+    error_logger.setLevel(logging.ERROR)
+
+
+def _shard_main(token, db_path, job, bucket, stats, workers, api_url=None):
+    """
+    Точка входа процесса-шарда: свой TeleBot, общий лимит и общие счётчики.
+    api_url — apihelper.API_URL родителя (свой сервер Bot API, заглушка в bench):
+    spawn-процесс начинает с настроек telebot по умолчанию.
+    """
+    from telebot import TeleBot, apihelper
+
+    _setup_shard_logging()
+    if api_url:
+        apihelper.API_URL = api_url
+    try:
+        broadcaster = Broadcaster(workers=workers, bucket=bucket)
+        run_job(broadcaster, db_path, job, job_sender(TeleBot(token), job), stats=stats)
+    except Exception as e:
+        error_logger.error(f"Ошибка шарда рассылки #{job['id']}\nError: {e}\n", exc_info=True)
+
+
+def run_sharded(token, db_path, job, processes, broadcaster, progress=None):
+    """
+    Выполняет (или продолжает) задание в processes процессах, каждый — со своим
+    диапазоном user_id и пулом из broadcaster.workers потоков.
+    Лимит скорости общий: broadcaster.bucket, если это SharedTokenBucket.
+    Возвращает JobCheckpoint родительского задания с суммарными итогами шардов.
+    """
+    from telebot import apihelper
+
+    ctx = shard_context()
+    children = job_shards(db_path, job["id"]) or create_shard_jobs(db_path, job, processes)
+    pending = [child for child in children if child["status"] == "running"]
+
+    bucket = broadcaster.bucket
+    if not isinstance(bucket, SharedTokenBucket):
+        bucket = SharedTokenBucket(bucket.target, ctx)
+    stats = SharedStats(ctx)
+
+    if progress:
+        progress.start(stats, sum(count_job_recipients(db_path, child["cursor"], child["upper"], child["segment"]) for child in pending))
+    try:
+        procs = [ctx.Process(target=_shard_main, daemon=True,
+                             args=(token, db_path, child, bucket, stats, broadcaster.workers, apihelper.API_URL))
+                 for child in pending]
+        for proc in procs:
+            proc.start()
+        # Итоги шардов читаются из БД, поэтому упавший процесс не подвешивает ожидание
+        for proc in procs:
+            proc.join()
+    finally:
+        stats.close()
+        if progress:
+            progress.stop()
+
+    children = job_shards(db_path, job["id"])
+    checkpoint = JobCheckpoint(db_path, job)
+    checkpoint.sent = sum(child["sent"] for child in children)
+    checkpoint.failed = sum(child["failed"] for child in children)
+    checkpoint.blocked = stats.blocked
+    checkpoint.stats = stats
+    if all(child["status"] == "done" for child in children):
+        checkpoint.finish()
+    return checkpoint
+
+
+# -----------------------
+# Живой прогресс рассылки
+# -----------------------
+def format_duration(seconds):
+    """Короткая запись длительности: «1 ч 5 мин», «3 мин 10 с», «12 с»."""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+
+class ProgressReporter:
+    """
+    Одно сообщение о ходе рассылки, которое редактируется на месте.
+    Отдельный поток раз в interval секунд читает счётчики и, если текст изменился,
+    вызывает update(text) (обычно bot.edit_message_text). Поток рассылки при этом
+    ничего не ждёт, а частые обновления схлопываются в одно редактирование.
+    """
+
+    def __init__(self, update, title="📤 Рассылка", interval=PROGRESS_INTERVAL):
+        self.update = update
+        self.title = title
+        self.interval = interval
+        self.stats = None
+        self.total = 0
+        self.last_text = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, stats, total):
+        self.stats = stats
+        self.total = total
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Останавливает поток и показывает финальные цифры."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self._push()
+
+    def render(self):
+        stats = self.stats
+        done = stats.sent + stats.failed
+        remaining = max(0, self.total - done)
+        speed = stats.rate
+        lines = [
+            self.title,
+            f"✅ Отправлено: {stats.sent} из {self.total}",
+            f"❌ Ошибок: {stats.failed - stats.blocked}",
+            f"🚫 Недоступны: {stats.blocked}",
+            f"⚡ Скорость: {speed:.1f} сообщ./с",
+        ]
+        if self.stopped.is_set():
+            lines.append("🏁 Завершено")
+        elif speed > 0:
+            lines.append(f"⏳ Осталось: ~{format_duration(remaining / speed)}")
+        return "\n".join(lines)
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self._push()
+
+    def _push(self):
+        if self.stats is None:
+            return
+        text = self.render()
+        if text == self.last_text:
+            return
+        try:
+            self.update(text)
+            self.last_text = text
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                error_logger.error(f"Ошибка обновления прогресса рассылки\nError: {e}\n")
+
+
+# -----------------------
+# Статусы получателей (blocked / deactivated / not_found)
+# -----------------------
+def ensure_status_columns(cursor):
+    """
+    Добавляет в list колонки status / status_ts / status_probes (если их нет) и индекс (status, user_id).
+    status_ts — когда статус был выставлен или последний раз перепроверен,
+    status_probes — сколько перепроверок подряд не удалось (для растущего интервала).
+    Вызывается из миграции ensure_db.
+    """
+    add_columns(cursor, "list", {"status": "TEXT", "status_ts": "REAL", "status_probes": "INTEGER"})
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_list_status ON list(status, user_id)")
+
+
+def mark_recipient(db_path, user_id, e):
+    """Помечает одиночного получателя по ошибке API. Возвращает статус или None."""
+    status = recipient_status(e)
+    if status:
+        with connect(db_path) as db:
+            cursor = db.cursor()
+            cursor.execute("UPDATE list SET status = ?, status_ts = ?, status_probes = 0 WHERE user_id = ?",
+                           (status, time.time(), user_id))
+            db.commit()
+    return status
+
+
+class StatusTracker:
+    """
+    Собирает недоступные чаты во время рассылки и пачками пишет их статус в БД
+    (одна транзакция на every отметок, а не на каждую).
+    reprobe=True — отметки перепроверки: счётчик неудачных status_probes растёт, а не сбрасывается.
+    """
+
+    def __init__(self, db_path, every=CHECKPOINT_EVERY, reprobe=False):
+        self.db_path = db_path
+        self.probes = "coalesce(status_probes, 0) + 1" if reprobe else "0"
+        self.every = max(1, every)
+        self.pending = []
+        self.marked = 0
+        self.lock = threading.Lock()
+
+    def record(self, user_id, e):
+        """Если ошибка означает «мёртвый» чат — запоминает его и возвращает статус, иначе None."""
+        status = recipient_status(e)
+        if status:
+            with self.lock:
+                self.pending.append((status, time.time(), user_id))
+                self.marked += 1
+                if len(self.pending) >= self.every:
+                    self._write()
+        return status
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if not self.pending:
+            return
+        with connect(self.db_path) as db:
+            cursor = db.cursor()
+            cursor.executemany(f"UPDATE list SET status = ?, status_ts = ?, status_probes = {self.probes} WHERE user_id = ?",
+                               self.pending)
+            db.commit()
+        self.pending = []
+
+
+class ReprobeResults:
+    """Наблюдатель для перепроверки: считает проверенные и запоминает, какие чаты снова доступны."""
+
+    def __init__(self):
+        self.checked = 0
+        self.alive = []
+        self.lock = threading.Lock()
+
+    def dispatched(self, user_id):
+        self.checked += 1
+
+    def completed(self, user_id, ok):
+        if ok:
+            with self.lock:
+                self.alive.append(user_id)
+
+
+def reprobe_recipients(broadcaster, db_path, probe, older_than):
+    """
+    Перепроверяет помеченные чаты, статус которых старше older_than секунд, — с растущим
+    интервалом: после каждой неудачной перепроверки чата он удваивается (до older_than * 2 ** REPROBE_MAX_DOUBLINGS).
+    probe(user_id) — лёгкий запрос к API без сообщения (send_chat_action). Если чат снова
+    доступен, пользователь на несколько секунд увидит «печатает…»; заблокировавшим бота
+    ничего не показывается — запрос просто падает.
+    Успех — статус сбрасывается (чат снова получает рассылки), иначе обновляются status_ts и status_probes.
+    Возвращает (проверено, восстановлено).
+    """
+    user_ids = iter_user_ids(db_path, "status IS NOT NULL AND status_ts < ? - ? * (1 << min(coalesce(status_probes, 0), ?))",
+                             (time.time(), older_than, REPROBE_MAX_DOUBLINGS))
+
+    results = ReprobeResults()
+    tracker = StatusTracker(db_path, reprobe=True)
+    broadcaster.run(user_ids, probe, on_error=lambda user_id, e: tracker.record(user_id, e), observers=(results,))
+    tracker.flush()
+
+    if results.alive:
+        with connect(db_path) as db:
+            cursor = db.cursor()
+            cursor.executemany("UPDATE list SET status = NULL, status_ts = NULL, status_probes = NULL WHERE user_id = ?",
+                               [(user_id,) for user_id in results.alive])
+            db.commit()
+    return results.checked, len(results.alive)
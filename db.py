@@ -0,0 +1,737 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Общий пул соединений SQLite (bot.py, secondary.py, broadcast.py, file_cache.py).
+
+Раньше каждый вызов открывал новое sqlite3.connect(DB_PATH): открытие файла,
+разбор схемы и пустой кэш страниц — на каждое входящее сообщение. Теперь
+соединения долгоживущие и переиспользуются всеми хендлерами и потоками:
+
+    with db_pool.connection() as db:     # или with connect(DB_PATH) as db:
+        cursor = db.cursor()
+        ...
+
+Как и sqlite3.connect в with, при выходе транзакция фиксируется (или
+откатывается при исключении), но соединение не закрывается, а возвращается
+в пул. Одно соединение в каждый момент используется только одним потоком.
+
+Каждое новое соединение один раз настраивается профилем PRAGMA (по умолчанию
+DEFAULT_PRAGMAS): журнал WAL, чтобы запись новых пользователей не блокировала
+чтение списков (и наоборот), synchronous=NORMAL, увеличенный кэш страниц,
+mmap, временные таблицы в памяти и busy_timeout вместо мгновенного
+«database is locked».
+
+Метрики пула (stats()): hits — взято готовое соединение, misses — открыто
+новое, waits / wait_time — сколько раз и сколько секунд ждали свободного.
+
+WriteBehind — буфер отложенной записи: строки (например, новые пользователи
+из echo_message) копятся в памяти и пишутся одной транзакцией executemany,
+когда набралось max_rows строк или прошло interval_ms. При выходе из процесса
+буфер дописывается (atexit).
+
+KnownUsers — индекс известных user_id в памяти (отсортированный array('q'),
+8 байт на пользователя), чтобы на сообщение уже известного пользователя
+не ходить в SQLite.
+
+LastSeen — обновление list.last_seen не чаще раза в interval на пользователя,
+отложенными пачками.
+
+migrate / add_columns — версионированные миграции схемы по PRAGMA user_version:
+на актуальной БД при запуске читается одно число, недостающие миграции
+применяются по порядку в одной транзакции.
+
+casefold / ensure_casefold_indexes — сравнение без учёта регистра для любых букв
+(COLLATE NOCASE сворачивает только латиницу): SQL-функция casefold() есть на
+каждом соединении пула, индексы list(casefold(поле)) — для /view и /export.
+Запись в list из внешних программ (консоль sqlite3) без этой функции не пройдёт.
+
+ensure_list_fts / fts_query — полнотекстовый поиск (FTS5) по полям list для /search.
+
+ensure_tags — нормализованные теги (tags + связь user_tags, по list.tag) для рассылок по сегментам.
+
+ensure_list_meta / data_version / list_meta — счётчик изменений list и число
+строк в нём (поддерживаются триггерами) и LRUCache — ограниченный кэш, например готовых страниц списков,
+с ключом, включающим версию данных.
+"""
+
+import atexit
+import bisect
+import collections
+import heapq
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+
+error_logger = logging.getLogger("Error")
+
+# Значения по умолчанию (переопределяются через .env в bot.py / secondary.py)
+DEFAULT_POOL_SIZE = 8
+
+# Сколько секунд ждать свободного соединения, прежде чем сдаться
+POOL_TIMEOUT = 30
+
+# Подготовленных выражений в кэше каждого соединения (sqlite3 по умолчанию держит 128)
+STATEMENT_CACHE_SIZE = 256
+
+# Профиль PRAGMA для нагруженного бота (порядок важен: journal_mode — первым)
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",     # в WAL без риска порчи БД, fsync только на checkpoint
+    "cache_size": -16000,        # отрицательное — в КиБ (~16 МБ на соединение)
+    "mmap_size": 268435456,      # 256 МБ чтения через mmap
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,        # мс ожидания блокировки записи
+}
+
+# Отложенная запись: сбрасывать буфер по стольким строкам или через столько мс
+FLUSH_ROWS = 500
+FLUSH_INTERVAL_MS = 200
+
+# Сколько новых user_id копить в наборе, прежде чем слить их в отсортированный массив
+KNOWN_MERGE_EVERY = 4096
+
+# last_seen обновляется не чаще раза в столько секунд на пользователя
+LAST_SEEN_INTERVAL = 3600
+
+
+class ConnectionPool:
+    """Потокобезопасный пул из не более чем size соединений к одной БД."""
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE, timeout=POOL_TIMEOUT, pragmas=None):
+        self.db_path = db_path
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.journal_mode = None
+        # LIFO: чаще всего берётся последнее вернувшееся — самое «тёплое» соединение
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _open(self):
+        # check_same_thread=False: соединение переходит между потоками, но не используется ими одновременно
+        # cached_statements: повторный execute той же строки SQL не разбирает её заново
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        try:
+            # deterministic: без этого SQLite не даст построить индекс по casefold(...)
+            conn.create_function("casefold", 1, casefold, deterministic=True)
+            # Профиль применяется один раз на соединение, а не на каждый запрос
+            for name, value in self.pragmas.items():
+                row = conn.execute(f"PRAGMA {name} = {value}").fetchone()
+                if name == "journal_mode" and row:
+                    self.journal_mode = row[0]
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def acquire(self):
+        """Берёт соединение из пула (открывает новое, пока их меньше size, иначе ждёт)."""
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+                self.misses += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        started = time.monotonic()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Нет свободного соединения с БД за {self.timeout} с (пул: {self.size})")
+        with self._lock:
+            self.waits += 1
+            self.wait_time += time.monotonic() - started
+        return conn
+
+    def release(self, conn):
+        """Возвращает соединение в пул (незавершённая транзакция откатывается)."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as db — как with sqlite3.connect(...), но из пула."""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """Метрики пула для логов и /db_stats."""
+        with self._lock:
+            checkouts = self.hits + self.misses + self.waits
+            return {
+                "size": self.size,
+                "journal_mode": self.journal_mode,
+                "open": self._created,
+                "idle": self._idle.qsize(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "hit_ratio": (self.hits + self.waits) / checkouts if checkouts else 0.0,
+            }
+
+
+# Один пул на файл БД и процесс (у процессов-шардов рассылки — свои соединения)
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Настройки (size, pragmas) по файлу БД — чтобы пулы в процессах-шардах были такими же
+_settings = {}
+
+
+def get_pool(db_path, size=None, pragmas=None):
+    """
+    Общий пул для db_path. size и pragmas учитываются только при первом создании
+    (дальше — те же настройки, в том числе в дочерних процессах).
+    """
+    path = os.path.abspath(db_path)
+    key = (path, os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            size, pragmas = _settings.setdefault(path, (size or DEFAULT_POOL_SIZE, pragmas))
+            pool = _pools[key] = ConnectionPool(db_path, size, pragmas=pragmas)
+        return pool
+
+
+def connect(db_path):
+    """Соединение из общего пула: with connect(db_path) as db."""
+    return get_pool(db_path).connection()
+
+
+class WriteBehind:
+    """
+    Буфер отложенной записи для одного запроса sql (INSERT ... VALUES(?, ...)).
+    add(key, row) — строка в буфер (повтор того же key заменяет строку);
+    фоновый поток пишет пачку через executemany по max_rows строк или раз в interval_ms.
+    """
+
+    def __init__(self, db_path, sql, max_rows=FLUSH_ROWS, interval_ms=FLUSH_INTERVAL_MS):
+        self.db_path = db_path
+        self.sql = sql
+        self.max_rows = max(1, int(max_rows))
+        self.interval = interval_ms / 1000
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.written = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, key, row):
+        with self._cond:
+            if not self._closed:
+                self._pending[key] = row
+                self._cond.notify()
+                return
+        # После close() — пишем сразу, чтобы ничего не потерять
+        self._write({key: row})
+
+    def __contains__(self, key):
+        with self._cond:
+            return key in self._pending
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _take(self):
+        rows, self._pending = self._pending, {}
+        return rows
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._pending)
+                # Первая строка пришла — ждём ещё, пока не наберётся пачка или не выйдет время
+                self._cond.wait_for(lambda: self._closed or len(self._pending) >= self.max_rows,
+                                    timeout=self.interval)
+                if self._closed:
+                    return
+                rows = self._take()
+            self._write(rows)
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            with connect(self.db_path) as db:
+                db.executemany(self.sql, list(rows.values()))
+                db.commit()
+        except sqlite3.OperationalError as e:
+            # БД занята дольше busy_timeout — вернём строки в буфер до следующей пачки
+            error_logger.error(f"Ошибка отложенной записи ({len(rows)} строк), повтор позже\nError: {e}\n", exc_info=True)
+            with self._cond:
+                for key, row in rows.items():
+                    self._pending.setdefault(key, row)
+            return
+        except Exception as e:
+            error_logger.error(f"Ошибка отложенной записи ({len(rows)} строк)\nError: {e}\n", exc_info=True)
+            return
+        with self._cond:
+            self.written += len(rows)
+            self.batches += 1
+
+    def flush(self):
+        """Немедленно пишет всё, что накопилось (в вызывающем потоке)."""
+        with self._cond:
+            rows = self._take()
+        self._write(rows)
+
+    def close(self):
+        """Останавливает фоновый поток и дописывает остаток буфера (вызывается и при выходе)."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+
+class KnownUsers:
+    """
+    Множество известных user_id: отсортированный array('q') (поиск — bisect)
+    плюс небольшой набор недавно добавленных, который время от времени
+    сливается в массив. Отдельно — user_id с выставленным status
+    (недоступные чаты), чтобы register_user мог их реактивировать.
+    Проверка «in» работает без блокировки; изменения — под lock.
+    """
+
+    def __init__(self, merge_every=KNOWN_MERGE_EVERY):
+        self.merge_every = merge_every
+        self._sorted = array("q")
+        self._recent = set()
+        self._inactive = set()
+        self._lock = threading.Lock()
+
+    def load(self, db_path):
+        """Загружает все user_id и недоступные чаты из list (при старте)."""
+        ids = array("q")
+        with connect(db_path) as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT user_id FROM list WHERE user_id IS NOT NULL ORDER BY user_id ASC")
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                ids.extend(row[0] for row in rows)
+        with self._lock:
+            self._sorted = ids
+            self._recent = set()
+        self.load_inactive(db_path)
+
+    def load_inactive(self, db_path):
+        """Перечитывает недоступные чаты (после рассылки и перепроверки; по индексу status)."""
+        with connect(db_path) as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT user_id FROM list WHERE status IS NOT NULL")
+            inactive = {row[0] for row in cursor.fetchall()}
+        with self._lock:
+            self._inactive = inactive
+
+    def __contains__(self, user_id):
+        if user_id in self._recent:
+            return True
+        ids = self._sorted
+        i = bisect.bisect_left(ids, user_id)
+        return i < len(ids) and ids[i] == user_id
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def is_inactive(self, user_id):
+        return user_id in self._inactive
+
+    def add(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            if user_id in self:
+                return
+            self._recent.add(user_id)
+            if len(self._recent) >= self.merge_every:
+                # Сначала новый массив, потом пустой набор — проверки без блокировки не теряют id
+                self._sorted = array("q", heapq.merge(self._sorted, sorted(self._recent)))
+                self._recent = set()
+
+    def discard(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            self._inactive.discard(user_id)
+            if user_id in self._recent:
+                self._recent.discard(user_id)
+                return
+            ids = array("q", self._sorted)
+            i = bisect.bisect_left(ids, user_id)
+            if i < len(ids) and ids[i] == user_id:
+                del ids[i]
+                self._sorted = ids
+
+    def set_inactive(self, user_id, inactive=True):
+        with self._lock:
+            if inactive:
+                self._inactive.add(int(user_id))
+            else:
+                self._inactive.discard(int(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._sorted = array("q")
+            self._recent = set()
+            self._inactive = set()
+
+
+class LastSeen:
+    """
+    Отметки активности (list.last_seen) без лишней записи:
+    в памяти — только пользователи, уже отмеченные в текущем окне interval,
+    повторные сообщения в окне ничего не пишут; остальное — пачками через
+    WriteBehind, а условие в UPDATE не даёт переписать свежий last_seen.
+    """
+
+    SQL = "UPDATE list SET last_seen = ? WHERE user_id = ? AND (last_seen IS NULL OR last_seen < ?)"
+
+    def __init__(self, db_path, interval=LAST_SEEN_INTERVAL, max_rows=FLUSH_ROWS, interval_ms=FLUSH_INTERVAL_MS):
+        self.interval = interval
+        self._window = None
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._writer = WriteBehind(db_path, self.SQL, max_rows=max_rows, interval_ms=interval_ms)
+
+    def _first_in_window(self, user_id, now):
+        window = int(now // self.interval)
+        with self._lock:
+            if window != self._window:
+                self._window = window
+                self._seen = set()
+            if user_id in self._seen:
+                return False
+            self._seen.add(user_id)
+            return True
+
+    def mark(self, user_id, now=None):
+        """Только запомнить отметку в окне (last_seen уже записан вместе с новой строкой)."""
+        self._first_in_window(user_id, now or time.time())
+
+    def touch(self, user_id, now=None):
+        """Отметить активность; в БД уходит не больше одной отметки за окно. True — если поставлена в очередь."""
+        now = now or time.time()
+        if not self._first_in_window(user_id, now):
+            return False
+        self._writer.add(user_id, (now, user_id, now - self.interval))
+        return True
+
+    def flush(self):
+        self._writer.flush()
+
+
+def add_columns(cursor, table, columns):
+    """
+    Добавляет в table недостающие колонки columns ({имя: тип}).
+    Для миграций: БД, созданные до user_version, могут уже иметь часть колонок.
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, decl in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def migrate(pool, migrations):
+    """
+    Применяет недостающие миграции. migrations — упорядоченный список функций f(cursor);
+    версия БД (PRAGMA user_version) — сколько из них уже применено.
+    Все недостающие выполняются в одной транзакции вместе с записью новой версии:
+    при ошибке схема остаётся прежней целиком. Возвращает (было, стало).
+    """
+    target = len(migrations)
+    with pool.connection() as db:
+        cursor = db.cursor()
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        if version >= target:
+            return version, version
+
+        # IMMEDIATE: второй процесс с той же БД дождётся и увидит уже новую версию
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        for migration in migrations[version:]:
+            migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {max(version, target)}")
+        db.commit()
+    return version, max(version, target)
+
+
+def ensure_list_fts(cursor, columns):
+    """
+    Полнотекстовый индекс list_fts (FTS5 поверх list, external content) по columns
+    и триггеры, которые держат его в актуальном состоянии при INSERT / UPDATE / DELETE.
+    Токенизатор unicode61 сам приводит регистр (в том числе кириллицу).
+    При первом создании индекс строится по уже существующим строкам.
+    """
+    cols = ", ".join(columns)
+    new_cols = ", ".join(f"new.{column}" for column in columns)
+    old_cols = ", ".join(f"old.{column}" for column in columns)
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'list_fts'")
+    created = cursor.fetchone() is None
+
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS list_fts USING fts5(
+            {cols}, content='list', content_rowid='id', tokenize='unicode61'
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS list_fts_ai AFTER INSERT ON list BEGIN
+            INSERT INTO list_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS list_fts_ad AFTER DELETE ON list BEGIN
+            INSERT INTO list_fts(list_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+        END
+    """)
+    # Только при изменении индексируемых полей (не status / last_seen)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS list_fts_au AFTER UPDATE OF {cols} ON list BEGIN
+            INSERT INTO list_fts(list_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            INSERT INTO list_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+
+    if created:
+        cursor.execute("INSERT INTO list_fts(list_fts) VALUES ('rebuild')")
+
+
+def fts_query(text):
+    """
+    Запрос FTS5 из текста админа: каждое слово — префикс, все слова обязательны.
+    "оле vip" -> '"оле"* "vip"*'. Пустая строка — если слов нет.
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text or ""))
+
+
+def ensure_list_meta(cursor, columns):
+    """
+    Таблица list_meta (key -> value) со счётчиком изменений 'version' и триггеры:
+    версия растёт при каждом INSERT / DELETE в list и при UPDATE отображаемых
+    columns (status, last_seen и т.п. версию не меняют). Счётчик 'rows' — точное
+    число строк list (+1 на INSERT, -1 на DELETE).
+    """
+    cols = ", ".join(columns)
+    cursor.execute("CREATE TABLE IF NOT EXISTS list_meta(key TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+    cursor.execute("INSERT OR IGNORE INTO list_meta(key, value) VALUES ('version', 0)")
+    bump = "UPDATE list_meta SET value = value + 1 WHERE key = 'version';"
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS list_meta_ai AFTER INSERT ON list BEGIN {bump} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS list_meta_ad AFTER DELETE ON list BEGIN {bump} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS list_meta_au AFTER UPDATE OF {cols} ON list BEGIN {bump} END")
+
+    # Точное число строк 'rows', чтобы общий список не считал COUNT(*) по всей таблице.
+    # Триггеры создаются раньше начального подсчёта: строки, вставленные между ними
+    # другим соединением, попадут либо в COUNT(*), либо (после него) в триггер.
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS list_rows_ai AFTER INSERT ON list BEGIN "
+                   "UPDATE list_meta SET value = value + 1 WHERE key = 'rows'; END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS list_rows_ad AFTER DELETE ON list BEGIN "
+                   "UPDATE list_meta SET value = value - 1 WHERE key = 'rows'; END")
+    cursor.execute("SELECT 1 FROM list_meta WHERE key = 'rows'")
+    if cursor.fetchone() is None:
+        cursor.execute("INSERT INTO list_meta(key, value) SELECT 'rows', COUNT(*) FROM list")
+
+
+def casefold(text):
+    """Ключ сравнения без учёта регистра (и латиницы, и кириллицы) — SQL-функция casefold."""
+    return text.casefold() if isinstance(text, str) else text
+
+
+def ensure_casefold_indexes(cursor, columns):
+    """
+    Индексы idx_list_<поле>_fold по casefold(поле) вместо idx_list_*_nocase:
+    фильтр WHERE casefold(поле) = casefold(?) находит «Олена» и по «ОЛЕНА».
+    """
+    for column in columns:
+        cursor.execute(f"DROP INDEX IF EXISTS idx_list_{column}_nocase")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_list_{column}_fold ON list(casefold({column}))")
+
+
+# Разделитель тегов в list.tag ("VIP, lead"); перевод строки тоже разделяет теги
+TAG_SEPARATOR = ", "
+
+# Значение, которым в /add пропускают поле, — не тег
+TAG_SKIP = "-"
+
+
+def split_tags(text):
+    """Теги из значения list.tag — по тем же правилам, что и триггеры ensure_tags (tag_values)."""
+    if any(ord(char) < 32 and char not in "\t\r\n" for char in text or ""):
+        return []
+    parts = (part.replace("\t", " ").strip(" ") for part in re.split(r"[,\r\n]", text or ""))
+    tags, seen = [], set()
+    for part in parts:
+        if part and part != TAG_SKIP and casefold(part) not in seen:
+            seen.add(casefold(part))
+            tags.append(part)
+    return tags
+
+
+def tag_values(expr):
+    """
+    SQL: теги из выражения expr (new.tag, list.tag) как строки json_each — столбец value.
+    CTE в триггерах SQLite недоступны, поэтому строка разбивается через JSON-массив:
+    'VIP, lead' → ["VIP"," lead"]. Строка с управляющими символами тегов не даёт.
+    """
+    text = f"replace(replace(replace(coalesce({expr}, ''), '\\', '\\\\'), '\"', '\\\"'), char(9), ' ')"
+    array = f"'[\"' || replace(replace(replace({text}, char(13), ','), char(10), ','), ',', '\",\"') || '\"]'"
+    return (f"json_each(CASE WHEN json_valid({array}) THEN {array} ELSE '[]' END) "
+            f"WHERE trim(value) NOT IN ('', '{TAG_SKIP}')")
+
+
+def ensure_tags(cursor):
+    """
+    Теги как сегменты получателей: tags (имя уникально по casefold — без учёта регистра
+    и для кириллицы) и связь многие-ко-многим
+    user_tags(tag_id, user_id). PRIMARY KEY (tag_id, user_id) — получатели сегмента
+    по возрастанию user_id (курсор рассылки), индекс (user_id, tag_id) — теги пользователя.
+    Источник правды — list.tag, теги через запятую ("VIP, lead"): /add, /replace_tag,
+    /import и /tag пишут туда, а связи повторяют его триггерами. При первом создании
+    связи строятся по уже заполненным tag.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tags'")
+    created = cursor.fetchone() is None
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS tags(id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE COLLATE NOCASE)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_tags(
+            tag_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_tags_user ON user_tags(user_id, tag_id)")
+    # «VIP» и «vip», «Вип» и «ВИП» — один тег; по этому же индексу ищется тег по имени
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tags_fold ON tags(casefold(name))")
+
+    # Пустые теги и "-" сегментом не считаются; UPDATE — сначала убрать старые связи, потом добавить новые.
+    # Без OR IGNORE: в триггере его перекрывает политика внешнего запроса (у upsert DO UPDATE — ABORT),
+    # поэтому уже существующие теги и связи отсекаются явно
+    link_new = f"""
+        INSERT INTO tags(name) SELECT trim(value) FROM {tag_values("new.tag")}
+            AND NOT EXISTS (SELECT 1 FROM tags WHERE casefold(name) = casefold(trim(value))) GROUP BY casefold(trim(value));
+        INSERT INTO user_tags(tag_id, user_id) SELECT tags.id, new.user_id FROM tags
+            WHERE new.user_id IS NOT NULL AND casefold(tags.name) IN (SELECT casefold(trim(value)) FROM {tag_values("new.tag")})
+            AND NOT EXISTS (SELECT 1 FROM user_tags WHERE tag_id = tags.id AND user_id = new.user_id);
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS list_tags_ai AFTER INSERT ON list BEGIN {link_new} END")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS list_tags_au AFTER UPDATE OF tag ON list WHEN old.tag IS NOT new.tag BEGIN
+            DELETE FROM user_tags WHERE user_id = old.user_id;
+            {link_new}
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS list_tags_ad AFTER DELETE ON list BEGIN
+            DELETE FROM user_tags WHERE user_id = old.user_id;
+        END
+    """)
+
+    if created:
+        cursor.execute(f"INSERT OR IGNORE INTO tags(name) SELECT trim(value) FROM list, {tag_values('list.tag')} "
+                       "GROUP BY casefold(trim(value))")
+        cursor.execute("INSERT OR IGNORE INTO user_tags(tag_id, user_id) "
+                       f"SELECT tags.id, list.user_id FROM list, tags, {tag_values('list.tag')} "
+                       "AND casefold(tags.name) = casefold(trim(value)) AND list.user_id IS NOT NULL")
+
+
+def data_version(db_path):
+    """Текущая версия данных list (см. ensure_list_meta)."""
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM list_meta WHERE key = 'version'")
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def list_meta(db_path):
+    """Все счётчики list_meta одним запросом: {'version': ..., 'rows': ...}."""
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT key, value FROM list_meta")
+        meta = dict(cursor.fetchall())
+    meta.setdefault('version', 0)
+    meta.setdefault('rows', 0)
+    return meta
+
+
+class LRUCache:
+    """Потокобезопасный кэш на maxsize записей: при переполнении вытесняется самая давняя по обращению."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = max(1, int(maxsize))
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
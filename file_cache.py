@@ -0,0 +1,159 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Кэш file_id для /send_file (общий для bot.py и secondary.py).
+
+Вложения из Telegram (документ, фото, видео, аудио, голосовое, анимация) уже
+лежат на серверах Telegram — рассылаются по их file_id. Локальные файлы и URL
+загружаются один раз: содержимое хэшируется (sha256), и пара (хэш, тип)
+запоминается в таблице file_cache вместе с полученным file_id. Все следующие
+отправки, в том числе в последующих рассылках, идут по file_id без загрузки.
+"""
+
+import hashlib
+import io
+import mimetypes
+import os
+import time
+import urllib.request
+
+from db import connect
+
+
+# Типы медиа, которые умеет /send_file (имя совпадает с полем Message и методом send_<kind>)
+MEDIA_KINDS = ("document", "photo", "video", "audio", "voice", "animation")
+
+# Лимит Bot API на загрузку файла ботом
+MAX_UPLOAD = 50 * 1024 * 1024
+
+FILE_CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS file_cache(
+        hash TEXT,
+        kind TEXT,
+        file_id TEXT,
+        created REAL,
+        PRIMARY KEY (hash, kind)
+    );
+"""
+
+
+def ensure_file_cache_table(cursor):
+    """Создаёт таблицу file_cache (миграция ensure_db)."""
+    cursor.execute(FILE_CACHE_SCHEMA)
+
+
+def media_from_message(message):
+    """(kind, file_id) вложения из сообщения или None. Для фото берётся самый большой размер."""
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            if kind == "photo":
+                media = media[-1]
+            return kind, media.file_id
+    return None
+
+
+def file_source(text, base_dir):
+    """
+    URL или путь к существующему файлу внутри base_dir (SEND_FILE_DIR) — иначе None.
+    Файлы вне base_dir (.env с токеном, БД, код бота) не отправляются даже по
+    абсолютному пути или через "..". Пустой base_dir — локальные файлы запрещены.
+    """
+    text = (text or "").strip()
+    if text.startswith(("http://", "https://")):
+        return text
+    if not text or not base_dir:
+        return None
+
+    base = os.path.realpath(base_dir)
+    path = os.path.realpath(os.path.join(base, text))
+    if os.path.commonpath([base, path]) != base or not os.path.isfile(path):
+        return None
+    return path
+
+
+def guess_kind(source):
+    """Тип отправки по имени файла / URL (по умолчанию — документ)."""
+    mime = mimetypes.guess_type(source.split("?", 1)[0])[0] or ""
+    if mime == "image/gif":
+        return "animation"
+    if mime.startswith("image/"):
+        return "photo"
+    if mime.startswith("video/"):
+        return "video"
+    if mime.startswith("audio/"):
+        return "audio"
+    return "document"
+
+
+def read_source(source):
+    """Содержимое локального файла или URL (не больше MAX_UPLOAD байт)."""
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=60) as response:
+            data = response.read(MAX_UPLOAD + 1)
+    else:
+        with open(source, "rb") as f:
+            data = f.read(MAX_UPLOAD + 1)
+
+    if len(data) > MAX_UPLOAD:
+        raise ValueError(f"Файл больше {MAX_UPLOAD // (1024 * 1024)} МБ: {source}")
+    return data
+
+
+def lookup(db_path, digest, kind):
+    """file_id из кэша по хэшу содержимого и типу или None."""
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT file_id FROM file_cache WHERE hash = ? AND kind = ?", (digest, kind))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def remember(db_path, digest, kind, file_id):
+    with connect(db_path) as db:
+        cursor = db.cursor()
+        cursor.execute("INSERT OR REPLACE INTO file_cache(hash, kind, file_id, created) VALUES(?, ?, ?, ?)",
+                       (digest, kind, file_id, time.time()))
+        db.commit()
+
+
+def send_media(bot, kind, chat_id, file):
+    """bot.send_document / send_photo / ... по типу kind."""
+    return getattr(bot, f"send_{kind}")(chat_id, file)
+
+
+def sent_file_id(sent, kind):
+    """file_id из ответа Telegram на отправку медиа."""
+    media = getattr(sent, kind)
+    if kind == "photo":
+        media = media[-1]
+    return media.file_id
+
+
+def upload_once(bot, db_path, source, chat_id):
+    """
+    (kind, file_id, cached) для локального файла или URL.
+    Если такое содержимое уже загружалось — берётся file_id из кэша (cached=True),
+    иначе файл загружается один раз в chat_id (чат админа) и file_id запоминается.
+    """
+    data = read_source(source)
+    kind = guess_kind(source)
+    digest = hashlib.sha256(data).hexdigest()
+
+    file_id = lookup(db_path, digest, kind)
+    if file_id:
+        return kind, file_id, True
+
+    upload = io.BytesIO(data)
+    upload.name = os.path.basename(source.split("?", 1)[0]) or "file"
+    sent = send_media(bot, kind, chat_id, upload)
+    file_id = sent_file_id(sent, kind)
+    remember(db_path, digest, kind, file_id)
+    return kind, file_id, False
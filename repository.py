@@ -0,0 +1,275 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Общий слой доступа к таблице list для bot.py и secondary.py.
+
+Раньше в каждом скрипте были свои копии одних и тех же запросов (insert_data,
+delete_data, fetch_page_rows, проверка Number в setting_replace_*). Теперь SQL
+собирается один раз при создании ListRepository из полей конкретного бота:
+
+    repo = ListRepository(db_pool, ("user", "name", "tag", "phone"), PAGE_SIZE)
+    if repo.exists(id):
+        repo.update(id, "name", name)
+
+Строки запросов не меняются от вызова к вызову, поэтому sqlite3 берёт уже
+подготовленное выражение из кэша соединения (cached_statements в db.py), а не
+разбирает SQL заново. Выбираются только нужные столбцы: проверка существования —
+SELECT 1, страницы списка — id, user_id и отображаемые поля (без status,
+first_seen и т.п.).
+
+Каждый запрос замеряется по имени (вместе с ожиданием соединения из пула):
+stats() — вызовы, суммарное и максимальное время; выводится в /db_stats.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from db import TAG_SEPARATOR, split_tags, casefold
+
+
+class ListRepository:
+    """Запросы к list для бота с полями fields (порядок — как в таблице и в data у upsert)."""
+
+    def __init__(self, pool, fields, page_size):
+        self.pool = pool
+        self.fields = tuple(fields)
+        self.page_size = page_size
+        # Столбцы строки страницы: row[0] — id (Number), row[1] — user_id, дальше fields
+        self.columns = ("id", "user_id") + self.fields
+        self._stats = {}
+        self._lock = threading.Lock()
+
+        cols = ", ".join(self.columns)
+        insert_cols = ", ".join(("user_id",) + self.fields + ("first_seen",))
+        placeholders = ", ".join("?" * (len(self.fields) + 2))
+        changed = " OR ".join(f"list.{f} IS NOT excluded.{f}" for f in self.fields)
+        self._sql = {
+            "exists": "SELECT 1 FROM list WHERE id = ?",
+            # У существующей записи меняются только отличающиеся поля, без изменений строка не пишется
+            "upsert": f"INSERT INTO list({insert_cols}) VALUES({placeholders}) "
+                      f"ON CONFLICT(user_id) DO UPDATE SET {', '.join(f'{f} = excluded.{f}' for f in self.fields)} "
+                      f"WHERE {changed}",
+            "rows": "SELECT value FROM list_meta WHERE key = 'rows'",
+            "user_id": "SELECT user_id FROM list WHERE id = ?",
+            "delete": "DELETE FROM list WHERE id = ?",
+            "clear": "DELETE FROM list",
+            "status": "SELECT status FROM list WHERE user_id = ?",
+            "reactivate": "UPDATE list SET status = NULL, status_ts = NULL WHERE user_id = ?",
+            "count_search": "SELECT COUNT(*) FROM list_fts WHERE list_fts MATCH ?",
+            # Совпадения из list_fts в порядке id (rowid list_fts = id в list)
+            "page_search": f"SELECT {', '.join('list.' + c for c in self.columns)} FROM list_fts "
+                           f"JOIN list ON list.id = list_fts.rowid "
+                           f"WHERE list_fts MATCH ? AND list_fts.rowid > ? ORDER BY list_fts.rowid ASC LIMIT ? OFFSET ?",
+            "page": f"SELECT {cols} FROM list WHERE id > ? ORDER BY id ASC LIMIT ? OFFSET ?",
+            # Теги-сегменты (db.ensure_tags): имя без учёта регистра (casefold), число участников — по PRIMARY KEY user_tags
+            "tags": "SELECT tags.name, COUNT(user_tags.user_id) FROM tags LEFT JOIN user_tags ON user_tags.tag_id = tags.id "
+                    "GROUP BY tags.id ORDER BY tags.name",
+            "tag_id": "SELECT id FROM tags WHERE casefold(name) = casefold(?)",
+            # Теги записи меняются только через list.tag — связи user_tags повторяют его триггерами
+            "tag_of": "SELECT tag FROM list WHERE id = ?",
+            "tag_set": "UPDATE list SET tag = ? WHERE id = ?",
+            "tag_members": "SELECT list.id, list.tag FROM user_tags JOIN list ON list.user_id = user_tags.user_id "
+                           "WHERE user_tags.tag_id = ?",
+            "tag_drop": "DELETE FROM tags WHERE id = ?",
+        }
+        for f in self.fields:
+            self._sql[f"update_{f}"] = f"UPDATE list SET {f} = ? WHERE id = ?"
+            # Сравнение без учёта регистра (и для кириллицы) — по индексу idx_list_*_fold (db.casefold)
+            self._sql[f"count_{f}"] = f"SELECT COUNT(*) FROM list WHERE casefold({f}) = casefold(?)"
+            self._sql[f"page_{f}"] = (f"SELECT {cols} FROM list WHERE casefold({f}) = casefold(?) AND id > ? "
+                                      f"ORDER BY id ASC LIMIT ? OFFSET ?")
+        if "tag" in self.fields:
+            # В tag может быть несколько тегов через запятую — фильтр /view по Tag идёт по связям user_tags
+            members = "SELECT user_id FROM user_tags WHERE tag_id = (SELECT id FROM tags WHERE casefold(name) = casefold(?))"
+            self._sql["count_tag"] = f"SELECT COUNT(*) FROM ({members})"
+            self._sql["page_tag"] = (f"SELECT {cols} FROM list WHERE user_id IN ({members}) AND id > ? "
+                                     f"ORDER BY id ASC LIMIT ? OFFSET ?")
+
+    # -----------------------
+    # Замеры
+    # -----------------------
+    @contextmanager
+    def _query(self, name):
+        """with self._query("имя") as cursor — курсор из пула + замер времени под именем name."""
+        started = time.perf_counter()
+        try:
+            with self.pool.connection() as db:
+                yield db.cursor()
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                calls, total, worst = self._stats.get(name, (0, 0.0, 0.0))
+                self._stats[name] = (calls + 1, total + elapsed, max(worst, elapsed))
+
+    def stats(self):
+        """[(имя, вызовов, всего с, максимум с), ...] — по убыванию суммарного времени."""
+        with self._lock:
+            items = [(name, *values) for name, values in self._stats.items()]
+        return sorted(items, key=lambda item: item[2], reverse=True)
+
+    def _sql_for(self, prefix, where):
+        key = f"{prefix}_{where}" if where else prefix
+        if key not in self._sql:
+            raise ValueError(f"Неизвестное поле list: {where}")
+        return key, self._sql[key]
+
+    # -----------------------
+    # Запросы
+    # -----------------------
+    def exists(self, id):
+        """Есть ли запись с Number id."""
+        with self._query("exists") as cursor:
+            cursor.execute(self._sql["exists"], (id,))
+            return cursor.fetchone() is not None
+
+    def upsert(self, data, now=None):
+        """Добавляет запись или обновляет её по user_id. data — (user_id, *fields)."""
+        with self._query("upsert") as cursor:
+            cursor.execute(self._sql["upsert"], (*data, time.time() if now is None else now))
+
+    def upsert_many(self, rows, now=None):
+        """
+        upsert пачки rows [(user_id, *fields), ...] одной транзакцией executemany.
+        Возвращает (добавлено, обновлено); новые строки видны по счётчику list_meta 'rows'.
+        """
+        now = time.time() if now is None else now
+        with self._query("upsert_many") as cursor:
+            # IMMEDIATE: между двумя чтениями счётчика в list никто другой не пишет
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(self._sql["rows"])
+            before = cursor.fetchone()[0]
+            cursor.executemany(self._sql["upsert"], ((*row, now) for row in rows))
+            # rowcount — вставленные и изменённые строки (без изменений upsert ничего не пишет)
+            changed = cursor.rowcount
+            cursor.execute(self._sql["rows"])
+            inserted = cursor.fetchone()[0] - before
+        return inserted, changed - inserted
+
+    def delete(self, id):
+        """Удаляет запись по Number. Возвращает её user_id или None, если такой нет."""
+        with self._query("delete") as cursor:
+            cursor.execute(self._sql["user_id"], (id,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(self._sql["delete"], (id,))
+        return row[0] if row else None
+
+    def update(self, id, field, value):
+        """Меняет одно поле записи с Number id."""
+        name, sql = self._sql_for("update", field)
+        with self._query(name) as cursor:
+            cursor.execute(sql, (value, id))
+
+    def clear(self):
+        """Удаляет все записи list."""
+        with self._query("clear") as cursor:
+            cursor.execute(self._sql["clear"])
+
+    def status(self, user_id):
+        """(status,) пользователя или None, если его нет в list."""
+        with self._query("status") as cursor:
+            cursor.execute(self._sql["status"], (user_id,))
+            return cursor.fetchone()
+
+    def reactivate(self, user_id):
+        """Сбрасывает статус недоступности (пользователь снова пишет боту)."""
+        with self._query("reactivate") as cursor:
+            cursor.execute(self._sql["reactivate"], (user_id,))
+
+    def tags(self):
+        """[(тег, участников), ...] по алфавиту."""
+        with self._query("tags") as cursor:
+            cursor.execute(self._sql["tags"])
+            return cursor.fetchall()
+
+    def tag_id(self, name):
+        """id тега (без учёта регистра) или None."""
+        with self._query("tag_id") as cursor:
+            cursor.execute(self._sql["tag_id"], (name,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def add_tag(self, id, name):
+        """Добавляет тег name в list.tag записи с Number id (тег создаётся триггером). True — если его там не было."""
+        with self._query("tag_add") as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(self._sql["tag_of"], (id,))
+            row = cursor.fetchone()
+            tags = split_tags(row[0]) if row else []
+            if not row or casefold(name) in map(casefold, tags):
+                return False
+            cursor.execute(self._sql["tag_set"], (TAG_SEPARATOR.join(tags + [name]), id))
+            return True
+
+    def remove_tag(self, id, name):
+        """Убирает тег name из list.tag записи с Number id. True — если он там был."""
+        with self._query("tag_remove") as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(self._sql["tag_of"], (id,))
+            row = cursor.fetchone()
+            tags = split_tags(row[0]) if row else []
+            rest = [tag for tag in tags if casefold(tag) != casefold(name)]
+            if len(rest) == len(tags):
+                return False
+            cursor.execute(self._sql["tag_set"], (TAG_SEPARATOR.join(rest), id))
+            return True
+
+    def drop_tag(self, name):
+        """
+        Убирает тег из list.tag у всех записей и удаляет его.
+        Возвращает, у скольких записей он был, или None, если тега нет.
+        """
+        with self._query("tag_drop") as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(self._sql["tag_id"], (name,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            cursor.execute(self._sql["tag_members"], (row[0],))
+            members = cursor.fetchall()
+            cursor.executemany(self._sql["tag_set"], (
+                (TAG_SEPARATOR.join(tag for tag in split_tags(tags) if casefold(tag) != casefold(name)), id)
+                for id, tags in members
+            ))
+            cursor.execute(self._sql["tag_drop"], (row[0],))
+            return len(members)
+
+    def count(self, where, where_val):
+        """Число совпадений фильтра: where — поле из fields или "search" (where_val — запрос FTS5)."""
+        name, sql = self._sql_for("count", where)
+        with self._query(name) as cursor:
+            cursor.execute(sql, (where_val,))
+            return cursor.fetchone()[0] or 0
+
+    def page(self, where, where_val, after_id, offset=0, limit=None):
+        """
+        Строки страницы (self.columns) с id > after_id, пропуская offset строк.
+        where — поле из fields, "search" или None (весь список); limit — по умолчанию page_size.
+        """
+        name, sql = self._sql_for("page", where)
+        params = (after_id, limit or self.page_size, offset)
+        with self._query(name) as cursor:
+            cursor.execute(sql, (where_val, *params) if where else params)
+            return cursor.fetchall()
+
+    def scan(self, where=None, where_val=None, batch_rows=5000):
+        """
+        Генератор всех строк фильтра (как в page) по возрастанию id, пачками по batch_rows.
+        Соединение берётся на каждую пачку, а не на всю выгрузку: другие хендлеры
+        не ждут его, а WAL не копится из-за долгого снимка чтения.
+        """
+        after_id = 0
+        while True:
+            rows = self.page(where, where_val, after_id, limit=batch_rows)
+            yield from rows
+            if len(rows) < batch_rows:
+                return
+            after_id = rows[-1][0]
@@ -1,23 +1,36 @@
-/*
- * CraftCore Launcher
- * Copyright (C) 2026 pexa6
- *
- * This program is free software: you can redistribute it and/or modify
- * it under the terms of the GNU General Public License as published by
- * the Free Software Foundation, either version 3 of the License.
-*/
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
 
 import telebot
 from telebot import TeleBot, types
 from telebot.apihelper import ApiTelegramException
 from dotenv import load_dotenv
-import sqlite3
 import logging
 import sys
 import os
 import uuid
 import math
 import time
+import threading
+import signal
+import tempfile
+
+from broadcast import (Broadcaster, ensure_jobs_table, create_job, unfinished_jobs, run_job,
+                       ensure_status_columns, mark_recipient, reprobe_recipients, ProgressReporter,
+                       job_sender, job_shards, run_sharded, SharedTokenBucket)
+from file_cache import ensure_file_cache_table, media_from_message, file_source, upload_once, send_media
+from db import (get_pool, DEFAULT_PRAGMAS, WriteBehind, KnownUsers, LastSeen, ensure_list_fts, fts_query,
+                ensure_list_meta, data_version, list_meta, LRUCache, migrate, add_columns, ensure_tags,
+                split_tags, ensure_casefold_indexes)
+from repository import ListRepository
+from transfer import (valid_user, valid_phone, valid_email, file_format, open_text, read_records, import_records, format_report,
+                      export_rows)
 
 
 load_dotenv()
@@ -67,14 +80,153 @@ DB_PATH = "database/secondary.db"
 # Кол-во записей на страницу (изменяй, если надо)
 PAGE_SIZE = 10
 
+# Сколько готовых страниц списков держать в памяти (сбрасываются при изменении list)
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256"))
+
+# Параметры массовой рассылки: темп (сообщений в секунду) и размер пула потоков
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+
+# Сколько процессов делят одну рассылку по диапазонам user_id (1 — без шардов)
+BROADCAST_PROCESSES = int(os.getenv("BROADCAST_PROCESSES", "1"))
+
+# Раз в сколько секунд перепроверять недоступные чаты (заблокировавшие бота и т.п.)
+STATUS_REPROBE_INTERVAL = int(os.getenv("STATUS_REPROBE_INTERVAL", "86400"))
+
+# Каталог, из которого /send_file может брать локальные файлы по пути (пусто — только вложения и URL)
+SEND_FILE_DIR = os.getenv("SEND_FILE_DIR", "files")
+
+# /export читает list пачками по столько строк (соединение с БД — на пачку)
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+
+# /import пишет пользователей пачками по столько строк (одна транзакция на пачку)
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "5000"))
+
+# Сколько самых затратных запросов к list показывать в /db_stats
+DB_STATS_TOP = int(os.getenv("DB_STATS_TOP", "5"))
+
+# Сколько долгоживущих соединений с БД держать для всех хендлеров и потоков (см. db.py)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# Профиль SQLite: WAL + PRAGMA, применяются один раз на каждое соединение пула
+DB_PRAGMAS = {
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", DEFAULT_PRAGMAS["journal_mode"]),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", DEFAULT_PRAGMAS["synchronous"]),
+    "cache_size": int(os.getenv("DB_CACHE_SIZE", DEFAULT_PRAGMAS["cache_size"])),
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", DEFAULT_PRAGMAS["mmap_size"])),
+    "temp_store": os.getenv("DB_TEMP_STORE", DEFAULT_PRAGMAS["temp_store"]),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT", DEFAULT_PRAGMAS["busy_timeout"])),
+}
+
+# Автоматическая регистрация новых пользователей пишется пачками:
+# одной транзакцией по REGISTER_FLUSH_ROWS строк или раз в REGISTER_FLUSH_MS мс
+REGISTER_FLUSH_ROWS = int(os.getenv("REGISTER_FLUSH_ROWS", "500"))
+REGISTER_FLUSH_MS = int(os.getenv("REGISTER_FLUSH_MS", "200"))
+
+# last_seen пользователя обновляется не чаще раза в столько секунд
+LAST_SEEN_INTERVAL = int(os.getenv("LAST_SEEN_INTERVAL", "3600"))
+
+# Режим работы: "sync" — обычный TeleBot, "async" — AsyncTeleBot (см. async_runtime.py)
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync").lower()
+
 # Убедиться, что папка для БД есть
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
+# Общий пул соединений: без открытия файла и разбора схемы на каждое сообщение
+db_pool = get_pool(DB_PATH, size=DB_POOL_SIZE, pragmas=DB_PRAGMAS)
+
+
+# -----------------------
+# Схема БД: миграции по PRAGMA user_version
+# -----------------------
+# Каждая миграция — функция f(cursor). Ранние повторяют то, что раньше проверялось
+# при каждом запуске, и безопасны для БД, созданных до user_version.
+def migration_list(cursor):
+    """Таблица list."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS list(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            user TEXT,
+            name TEXT,
+            tag TEXT,
+            phone TEXT,
+            email TEXT,
+            instagram TEXT,
+            tiktok TEXT
+        );
+    """)
+
+
+def migration_contacts(cursor):
+    """Колонки email / instagram / tiktok (list из первых версий бота)."""
+    add_columns(cursor, "list", {"email": "TEXT", "instagram": "TEXT", "tiktok": "TEXT"})
+
+
+def migration_broadcast(cursor):
+    """Статус получателя (blocked / deactivated / not_found), задания рассылки, кэш file_id для /send_file."""
+    ensure_status_columns(cursor)
+    ensure_jobs_table(cursor)
+    ensure_file_cache_table(cursor)
+
+
+def migration_seen(cursor):
+    """Время появления и последней активности пользователя."""
+    add_columns(cursor, "list", {"first_seen": "REAL", "last_seen": "REAL"})
+
+
+def migration_nocase_indexes(cursor):
+    """Поиск в /view без учёта регистра — по индексам, а не полным проходом таблицы."""
+    for column in ("user", "name", "tag", "email", "instagram", "tiktok"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_list_{column}_nocase ON list({column} COLLATE NOCASE)")
+
+
+def migration_list_fts(cursor):
+    """Полнотекстовый индекс для /search (FTS5, обновляется триггерами)."""
+    ensure_list_fts(cursor, ("user", "name", "tag", "email", "instagram", "tiktok"))
+
+
+def migration_list_meta(cursor):
+    """Счётчики изменений и строк list (для кэша страниц и подсчётов), тоже на триггерах."""
+    ensure_list_meta(cursor, ("user_id", "user", "name", "tag", "phone", "email", "instagram", "tiktok"))
+
+
+def migration_tags(cursor):
+    """Теги-сегменты (tags / user_tags) для /tag и рассылок по сегменту, сегмент у заданий рассылки."""
+    ensure_tags(cursor)
+    ensure_jobs_table(cursor)
+
+
+def migration_casefold_indexes(cursor):
+    """Фильтры /view и /export без учёта регистра и для кириллицы: индексы по casefold() (Tag — через user_tags)."""
+    ensure_casefold_indexes(cursor, ("user", "name", "email", "instagram", "tiktok"))
+    cursor.execute("DROP INDEX IF EXISTS idx_list_tag_nocase")
+
+
+def migration_status_probes(cursor):
+    """Счётчик неудачных перепроверок недоступного чата (растущий интервал перепроверки)."""
+    ensure_status_columns(cursor)
+
+
+# Версия схемы = число применённых миграций. Порядок не меняется, новые — только в конец.
+MIGRATIONS = (
+    migration_list,
+    migration_contacts,
+    migration_broadcast,
+    migration_seen,
+    migration_nocase_indexes,
+    migration_list_fts,
+    migration_list_meta,
+    migration_tags,
+    migration_casefold_indexes,
+    migration_status_probes,
+)
+
 
 def ensure_db():
     """
-    Создаёт таблицу list, если её нет.
-    Если таблица уже есть, но в ней не хватает новых колонок — добавляет их.
+    Приводит схему БД к последней версии (MIGRATIONS по PRAGMA user_version):
+    на актуальной БД — одно чтение user_version, без проверок колонок.
     Структура таблицы:
         id         INTEGER PRIMARY KEY AUTOINCREMENT
         user_id    INTEGER UNIQUE
@@ -85,37 +237,60 @@ def ensure_db():
         email      TEXT
         instagram  TEXT
         tiktok     TEXT
+        status     TEXT  (NULL — активен, иначе blocked / deactivated / not_found)
+        status_ts  REAL  (когда статус выставлен / перепроверен)
+        first_seen REAL  (когда запись появилась)
+        last_seen  REAL  (когда пользователь последний раз писал боту, с точностью до LAST_SEEN_INTERVAL)
     """
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS list(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE,
-                user TEXT,
-                name TEXT,
-                tag TEXT,
-                phone TEXT,
-                email TEXT,
-                instagram TEXT,
-                tiktok TEXT
-            );
-        """)
-
-        cursor.execute("PRAGMA table_info(list)")
-        columns = [row[1] for row in cursor.fetchall()]
-
-        if "email" not in columns:
-            cursor.execute("ALTER TABLE list ADD COLUMN email TEXT")
-        if "instagram" not in columns:
-            cursor.execute("ALTER TABLE list ADD COLUMN instagram TEXT")
-        if "tiktok" not in columns:
-            cursor.execute("ALTER TABLE list ADD COLUMN tiktok TEXT")
-
-        db.commit()
-
-
-ensure_db()
+    old, new = migrate(db_pool, MIGRATIONS)
+    if old != new:
+        user_logger.info(f"Схема БД обновлена: версия {old} → {new}")
+
+
+# Все запросы к list (общие с bot.py): подготовленные выражения и замеры для /db_stats
+repo = ListRepository(db_pool, ("user", "name", "tag", "phone", "email", "instagram", "tiktok"), PAGE_SIZE)
+
+# Известные user_id в памяти: сообщения уже записанных пользователей не трогают SQLite
+known_users = KnownUsers()
+
+# Создаются в start_runtime(): движок рассылки, буфер регистраций, отметки активности
+broadcaster = None
+registrations = None
+last_seen = None
+
+
+def start_runtime():
+    """
+    Инициализация процесса бота: миграции БД, движок рассылки, фоновые буферы записи
+    и индекс известных user_id. Вызывается при запуске, а не при импорте: процессы-шарды
+    рассылки (spawn) импортируют этот скрипт заново как __mp_main__, и ни полный проход
+    по list, ни лишние потоки им не нужны.
+    """
+    global broadcaster, registrations, last_seen
+
+    ensure_db()
+
+    # Один общий движок рассылки на бота — лимит скорости глобальный
+    # (при нескольких процессах — в разделяемой памяти, общий и для шардов)
+    broadcaster = Broadcaster(
+        rate=BROADCAST_RATE,
+        workers=BROADCAST_WORKERS,
+        bucket=SharedTokenBucket(BROADCAST_RATE) if BROADCAST_PROCESSES > 1 else None
+    )
+
+    # Буфер новых пользователей из echo_message (DO NOTHING: запись из /add не перетирается)
+    registrations = WriteBehind(
+        DB_PATH,
+        "INSERT INTO list(user_id, user, name, tag, phone, email, instagram, tiktok, first_seen, last_seen) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(user_id) DO NOTHING",
+        max_rows=REGISTER_FLUSH_ROWS,
+        interval_ms=REGISTER_FLUSH_MS
+    )
+
+    # Отметки активности (last_seen) — не чаще раза в LAST_SEEN_INTERVAL, тоже пачками
+    last_seen = LastSeen(DB_PATH, interval=LAST_SEEN_INTERVAL, max_rows=REGISTER_FLUSH_ROWS, interval_ms=REGISTER_FLUSH_MS)
+
+    known_users.load(DB_PATH)
+
 
 # Кнопки основного меню (ReplyKeyboard)
 start = types.ReplyKeyboardMarkup(one_time_keyboard=True)
@@ -123,6 +298,7 @@ start.add(
     "/add",
     "/all",
     "/view",
+    "/search",
     "/send_message",
     "/send_file",
     "/replace_name",
@@ -132,13 +308,33 @@ start.add(
     "/replace_instagram",
     "/replace_tiktok",
     "/delete",
-    "/clear_db"
+    "/clear_db",
+    "/import",
+    "/export",
+    "/tag"
 )
 
 # Варианты выбора (используется для /view и /send_message и т.д.)
 variant = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
 variant.add("1", "2")
 
+# Варианты для /view (по какому полю искать)
+view_variant = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+view_variant.add("1", "2", "3", "4", "5", "6")
+
+
+# Варианты для /send_message и /send_file (всем, по ID, сегменту)
+send_variant = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+send_variant.add("1", "2", "3")
+
+# Действия /tag
+tag_variant = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+tag_variant.add("1", "2", "3", "4")
+
+# Варианты для /export (0 — без фильтра, дальше как в /view)
+export_variant = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+export_variant.add("0", "1", "2", "3", "4", "5", "6")
+
 
 def crash_bot():
     """Попытка уведомить администратора при краше polling()."""
@@ -153,17 +349,14 @@ def crash_bot():
 # -----------------------
 def insert_data(data):
     """
-    Вставляет или заменяет запись по уникальному user_id.
+    Добавляет запись или обновляет её по уникальному user_id (UPSERT).
     data — кортеж (user_id, user, name, tag, phone, email, instagram, tiktok)
-    Используется при автоматическом логировании входящих сообщений и при /add.
+    У существующей записи меняются только отличающиеся поля: id (Number) остаётся прежним,
+    first_seen / last_seen и статус не трогаются, а без изменений строка вообще не пишется.
+    Используется при /add (новые пользователи из входящих сообщений пишутся пачками — registrations).
     """
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "INSERT OR REPLACE INTO list(user_id, user, name, tag, phone, email, instagram, tiktok) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-            data
-        )
-        db.commit()
+    repo.upsert(data)
+    known_users.add(data[0])
 
 
 def delete_data(message, id):
@@ -172,17 +365,13 @@ def delete_data(message, id):
     В случае успеха отправляет ответ пользователю.
     """
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("SELECT * FROM list WHERE id=?", (id,))
-            result = cursor.fetchone()
-
-            if result:
-                cursor.execute("DELETE FROM list WHERE id=?", (id,))
-                db.commit()
-                bot.reply_to(message, "✅ Запись успешно удалена.")
-            else:
-                bot.reply_to(message, "❔ Такой Number не найден.")
+        user_id = repo.delete(id)
+
+        if user_id is not None:
+            known_users.discard(user_id)
+            bot.reply_to(message, "✅ Запись успешно удалена.")
+        else:
+            bot.reply_to(message, "❔ Такой Number не найден.")
     except Exception as e:
         error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id', 'unknown')}\nError: {e}\n", exc_info=True)
         bot.reply_to(message, f"❌ Ошибка\n/delete")
@@ -191,24 +380,36 @@ def delete_data(message, id):
 # -----------------------
 # Пагинация (session-based)
 # -----------------------
-# PAGINATION_SESSIONS: token -> { where, where_val, count, pages, ts }
+# PAGINATION_SESSIONS: token -> { where, where_val, count, pages, after, ts }
+# after: {page: id} — после какого id начинается уже открытая страница (keyset-пагинация)
 PAGINATION_SESSIONS = {}
 
+# Готовые страницы: (фильтр, страница, начало страницы, заголовок, версия list) -> (текст, граница следующей)
+page_cache = LRUCache(PAGE_CACHE_SIZE)
+
+# Число совпадений фильтра: (поле, значение, версия list) -> count
+count_cache = LRUCache(PAGE_CACHE_SIZE)
+
 
 def create_pagination_session(where=None, where_val=None):
     """
     Создаёт сессию пагинации:
-    - where: имя поля WHERE (например "user" или "name") или None для общего списка
-    - where_val: значение для WHERE
+    - where: имя поля WHERE (например "user" или "name"), "search" — полнотекстовый
+      поиск (/search, where_val — запрос FTS5) или None для общего списка
+    - where_val: значение для WHERE (сравнение без учёта регистра, по индексу *_fold)
     Возвращает токен сессии.
     """
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        if where and where_val is not None:
-            cursor.execute(f"SELECT COUNT(*) FROM list WHERE {where}=?", (where_val,))
-        else:
-            cursor.execute("SELECT COUNT(*) FROM list")
-        total = cursor.fetchone()[0] or 0
+    meta = list_meta(DB_PATH)
+    if where == "search" or (where and where_val is not None):
+        # Счёт по фильтру кэшируется до следующего изменения list
+        key = (where, where_val, meta['version'])
+        total = count_cache.get(key)
+        if total is None:
+            total = repo.count(where, where_val)
+            count_cache.put(key, total)
+    else:
+        # Общий список: число строк поддерживают триггеры list_meta, без COUNT(*)
+        total = meta['rows']
 
     pages = max(1, math.ceil(total / PAGE_SIZE))
     token = uuid.uuid4().hex
@@ -217,6 +418,7 @@ def create_pagination_session(where=None, where_val=None):
         'where_val': where_val,
         'count': total,
         'pages': pages,
+        'after': {0: 0},
         'ts': time.time()
     }
     return token
@@ -238,21 +440,25 @@ def fetch_page_rows(token, page):
     Возвращает (rows, total_pages) для заданного токена и номера страницы.
     rows — список кортежей из БД.
     page — 0-based.
+    Страница ищется по id (WHERE id > ?), а не через OFFSET: для каждой открытой
+    страницы сессия запоминает id, после которого начинается следующая, поэтому
+    любая страница стоит одинаково, а новые записи не сдвигают уже листаемый список.
     """
     sess = PAGINATION_SESSIONS.get(token)
     if not sess:
         return [], 0
-    offset = page * PAGE_SIZE
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        if sess['where'] and sess['where_val'] is not None:
-            cursor.execute(
-                f"SELECT * FROM list WHERE {sess['where']}=? ORDER BY id ASC LIMIT ? OFFSET ?",
-                (sess['where_val'], PAGE_SIZE, offset)
-            )
-        else:
-            cursor.execute("SELECT * FROM list ORDER BY id ASC LIMIT ? OFFSET ?", (PAGE_SIZE, offset))
-        rows = cursor.fetchall()
+
+    # Ближайшая известная граница не дальше нужной страницы (обычно — она сама)
+    known = max(k for k in sess['after'] if k <= page)
+    after_id = sess['after'][known]
+    offset = (page - known) * PAGE_SIZE
+
+    where = sess['where'] if sess['where'] == "search" or sess['where_val'] is not None else None
+    rows = repo.page(where, sess['where_val'], after_id, offset)
+
+    if rows:
+        sess['after'][page] = after_id if offset == 0 else rows[0][0] - 1
+        sess['after'][page + 1] = rows[-1][0]
     return rows, sess['pages']
 
 
@@ -288,6 +494,31 @@ def format_rows_text(rows, header_prefix=""):
     return header_prefix + "\n\n═════════════════════════\n\n".join(lines)
 
 
+def render_page(token, page, header_prefix=""):
+    """
+    Возвращает (text, total_pages) страницы page сессии token.
+    Готовый текст берётся из page_cache, пока list не менялся (версия из list_meta),
+    поэтому листание одного и того же списка не ходит за строками и не форматирует их заново.
+    """
+    sess = PAGINATION_SESSIONS.get(token)
+    if not sess:
+        return format_rows_text([], header_prefix=header_prefix), 0
+
+    key = (sess['where'], sess['where_val'], page, sess['after'].get(page), header_prefix, data_version(DB_PATH))
+    cached = page_cache.get(key)
+    if cached:
+        text, next_after = cached
+        # Граница следующей страницы — как если бы страница была прочитана из БД
+        if next_after is not None:
+            sess['after'][page + 1] = next_after
+        return text, sess['pages']
+
+    rows, pages = fetch_page_rows(token, page)
+    text = format_rows_text(rows, header_prefix=header_prefix)
+    page_cache.put(key, (text, rows[-1][0] if rows else None))
+    return text, pages
+
+
 def build_pagination_markup(token, current_page, total_pages):
     """
     Строит InlineKeyboardMarkup для пагинации:
@@ -322,8 +553,7 @@ def send_paginated_list(chat_id, where=None, where_val=None, header_prefix=""):
     """
     cleanup_old_sessions()
     token = create_pagination_session(where, where_val)
-    rows, pages = fetch_page_rows(token, 0)
-    text = format_rows_text(rows, header_prefix=header_prefix)
+    text, pages = render_page(token, 0, header_prefix=header_prefix)
     markup = build_pagination_markup(token, 0, pages)
     try:
         sent = bot.send_message(chat_id, text, reply_markup=markup)
@@ -368,8 +598,7 @@ def handle_pagination(call):
                 pass
             return
 
-        rows, pages = fetch_page_rows(token, page)
-        text = format_rows_text(rows)
+        text, pages = render_page(token, page)
         markup = build_pagination_markup(token, page, pages)
 
         try:
@@ -391,6 +620,39 @@ def handle_pagination(call):
 # -----------------------
 # Обработка входящих сообщений (автоматическая запись пользователей)
 # -----------------------
+def register_user(message):
+    """
+    Отмечает активность автора сообщения (last_seen) и добавляет его в БД, если его там ещё нет (остальные поля пустые).
+    Используется в echo_message и в asyncio-режиме (async_runtime.py).
+    """
+    user_id = int(f"{message.from_user.id}")
+
+    # Частый путь: пользователь уже известен и доступен для рассылок — без запроса к SQLite
+    if user_id in known_users and not known_users.is_inactive(user_id):
+        last_seen.touch(user_id)
+        return
+
+    username = message.from_user.username or ""
+    user = str(f"@{username}") if username else ""
+    name = str(f"{message.from_user.first_name}") if message.from_user.first_name else ""
+
+    result = repo.status(user_id)
+
+    # Пользователь снова пишет боту — значит, он доступен для рассылок
+    if result and result[0]:
+        repo.reactivate(user_id)
+        known_users.set_inactive(user_id, False)
+
+    now = time.time()
+    if result or user_id in registrations:
+        last_seen.touch(user_id, now)
+    else:
+        # В общей пачке (см. registrations)
+        registrations.add(user_id, (user_id, user, name, "", "", "", "", "", now, now))
+        last_seen.mark(user_id, now)
+    known_users.add(user_id)
+
+
 @bot.message_handler(func=lambda message: message.from_user.id != ADMIN)
 def echo_message(message):
     """
@@ -399,10 +661,7 @@ def echo_message(message):
     - посылает уведомление админу (если возможно)
     - добавляет пользователя в БД, если его там нет
     """
-    user_id = int(f"{message.from_user.id}")
     username = message.from_user.username or ""
-    user = str(f"@{username}") if username else ""
-    name = str(f"{message.from_user.first_name}") if message.from_user.first_name else ""
 
     user_logger.info(f"ID: {message.from_user.id} | User: @{username} | Wrote: {message.text}")
     try:
@@ -410,15 +669,7 @@ def echo_message(message):
     except:
         pass
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT COUNT(*) FROM list WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-
-    if result and result[0] > 0:
-        pass
-    else:
-        insert_data((user_id, user, name, "", "", "", "", ""))
+    register_user(message)
 
 
 # -----------------------
@@ -432,6 +683,7 @@ def send_welcome(message):
                           "/add – Записать User.\n"
                           "/all – Все записаны Users.\n"
                           "/view – Просмотреть записи по определенным критериям.\n"
+                          "/search – Поиск по всем полям (/search текст).\n"
                           "/send_message – Отправить сообщение по определенным критериям.\n"
                           "/send_file – Отправить файл по определенным критериям.\n"
                           "/replace_name – Заменить Name по Number.\n"
@@ -440,8 +692,12 @@ def send_welcome(message):
                           "/replace_email – Заменить Email по Number.\n"
                           "/replace_instagram – Заменить Instagram по Number.\n"
                           "/replace_tiktok – Заменить Tiktok по Number.\n"
+                          "/tag – Теги-сегменты: список, добавить / убрать у записи, удалить.\n"
                           "/delete – Удалить запись по Number.\n"
-                          "/clear_db – Очистить всю базу данных.", reply_markup=start)
+                          "/clear_db – Очистить всю базу данных.\n"
+                          "/import – Загрузить записи из CSV / JSONL.\n"
+                          "/export – Выгрузить записи в CSV / JSONL (.gz).\n"
+                          "/db_stats – Метрики БД.", reply_markup=start)
 
 
 # -----------------------
@@ -469,12 +725,10 @@ def write_user(message, user_id):
     """Получаем @user и проверяем валидность символов."""
     user = message.text.strip()
 
-    if user.startswith('@') and len(user) > 1:
-        valid_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
-        if all(char in valid_chars for char in user[1:]):
-            bot.send_message(message.chat.id, "Введите Name:")
-            bot.register_next_step_handler(message, write_name, user_id, user)
-            return
+    if valid_user(user):
+        bot.send_message(message.chat.id, "Введите Name:")
+        bot.register_next_step_handler(message, write_name, user_id, user)
+        return
 
     bot.reply_to(message, "❌ Введите тег в формате (@User).\n/add")
 
@@ -482,13 +736,15 @@ def write_user(message, user_id):
 def write_name(message, user_id, user):
     """Получаем имя (name)."""
     name = message.text.strip()
-    bot.send_message(message.chat.id, "Введите Tag или - если нет:")
+    bot.send_message(message.chat.id, "Введите Tag (несколько — через запятую) или - если нет:")
     bot.register_next_step_handler(message, write_tag, user_id, user, name)
 
 
 def write_tag(message, user_id, user, name):
     """Получаем tag (или '-' чтобы пропустить)."""
     tag = message.text.strip()
+    if tag == "-":
+        tag = ""
     bot.send_message(message.chat.id, "Введите номер телефона в формате (пример: +380XXXXXXXXX) или - если не знаете.")
     bot.register_next_step_handler(message, write_phone, user_id, user, name, tag)
 
@@ -498,7 +754,7 @@ def write_phone(message, user_id, user, name, tag):
     phone = message.text.strip()
 
     is_skip = phone == "-"
-    is_phone = phone.startswith('+') and len(phone) > 1 and phone[1:].isdigit()
+    is_phone = valid_phone(phone)
 
     if is_skip or is_phone:
         if is_skip:
@@ -517,7 +773,7 @@ def write_email(message, user_id, user, name, tag, phone):
     email = message.text.strip()
 
     is_skip = email == "-"
-    is_email = "@" in email and "." in email and len(email) > 3
+    is_email = valid_email(email)
 
     if is_skip or is_email:
         if is_skip:
@@ -574,10 +830,14 @@ def view_all_id(message):
 # -----------------------
 @bot.message_handler(commands=['view'])
 def view_id(message):
-    """Выбор критерия для просмотра — по User или по Name."""
-    bot.reply_to(message, "Выберите критерий для просмотра записей:\n"
+    """Выбор критерия для просмотра — по User, Name, Tag, Email, Instagram или TikTok."""
+    bot.reply_to(message, "Выберите критерий для просмотра записей (без учёта регистра):\n"
                           "1 - По User.\n"
-                          "2 - По Name.\n", reply_markup=variant)
+                          "2 - По Name.\n"
+                          "3 - По Tag.\n"
+                          "4 - По Email.\n"
+                          "5 - По Instagram.\n"
+                          "6 - По TikTok.\n", reply_markup=view_variant)
     bot.register_next_step_handler(message, view_user_name)
 
 
@@ -591,6 +851,18 @@ def view_user_name(message):
     elif variant_choice == "2":
         msg = bot.send_message(message.chat.id, "Введите Name для просмотра записей:")
         bot.register_next_step_handler(msg, process_view_name)
+    elif variant_choice == "3":
+        msg = bot.send_message(message.chat.id, "Введите Tag для просмотра записей:")
+        bot.register_next_step_handler(msg, process_view_tag)
+    elif variant_choice == "4":
+        msg = bot.send_message(message.chat.id, "Введите Email для просмотра записей:")
+        bot.register_next_step_handler(msg, process_view_email)
+    elif variant_choice == "5":
+        msg = bot.send_message(message.chat.id, "Введите Instagram для просмотра записей:")
+        bot.register_next_step_handler(msg, process_view_instagram)
+    elif variant_choice == "6":
+        msg = bot.send_message(message.chat.id, "Введите TikTok для просмотра записей:")
+        bot.register_next_step_handler(msg, process_view_tiktok)
     else:
         bot.reply_to(message, "❌ Неверный выбор.\n/view")
 
@@ -607,15 +879,60 @@ def process_view_name(message):
     send_paginated_list(message.chat.id, where="name", where_val=name)
 
 
+def process_view_tag(message):
+    """Фильтруем по tag и отправляем пагинированный результат."""
+    tag = message.text.strip()
+    send_paginated_list(message.chat.id, where="tag", where_val=tag)
+
+
+def process_view_email(message):
+    """Фильтруем по email и отправляем пагинированный результат."""
+    email = message.text.strip()
+    send_paginated_list(message.chat.id, where="email", where_val=email)
+
+
+def process_view_instagram(message):
+    """Фильтруем по instagram и отправляем пагинированный результат."""
+    instagram = message.text.strip()
+    send_paginated_list(message.chat.id, where="instagram", where_val=instagram)
+
+
+def process_view_tiktok(message):
+    """Фильтруем по tiktok и отправляем пагинированный результат."""
+    tiktok = message.text.strip()
+    send_paginated_list(message.chat.id, where="tiktok", where_val=tiktok)
+
+
+@bot.message_handler(commands=['search'])
+def search(message):
+    """
+    Полнотекстовый поиск по User / Name / Tag / Email / Instagram / TikTok: /search оле vip
+    Каждое слово ищется по началу, в записи должны найтись все слова; регистр не важен.
+    """
+    text = message.text.partition(" ")[2].strip()
+    query = fts_query(text)
+
+    if not query:
+        bot.reply_to(message, "Введите запрос после команды, например:\n/search оле vip", reply_markup=start)
+        return
+
+    try:
+        send_paginated_list(message.chat.id, where="search", where_val=query, header_prefix=f"🔎 Поиск: {text}\n\n")
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, f"❌ Ошибка\n/search")
+
+
 # -----------------------
 # Отправка сообщений (/send_message)
 # -----------------------
 @bot.message_handler(commands=['send_message'])
 def setting_send_message(message):
-    """Критерий отправки сообщения — всем или по ID."""
+    """Критерий отправки сообщения — всем, по ID или сегменту (тегу)."""
     bot.reply_to(message, "Выберите критерий для отправки сообщения:\n"
                           "1 - Отправить всем.\n"
-                          "2 - Отправить по ID.\n", reply_markup=variant)
+                          "2 - Отправить по ID.\n"
+                          "3 - Отправить сегменту (по тегу).\n", reply_markup=send_variant)
     bot.register_next_step_handler(message, variant_send_message)
 
 
@@ -632,33 +949,108 @@ def variant_send_message(message):
         send_paginated_list(message.chat.id)
         msg = bot.send_message(message.chat.id, "Выделите ID кому хотите отправить сообщение:", reply_markup=start)
         bot.register_next_step_handler(msg, setting_send_message_id)
+    elif variant_choice == "3":
+        bot.send_message(message.chat.id, format_tags_text())
+        msg = bot.send_message(message.chat.id, "Введите тег, участникам которого отправить сообщение:", reply_markup=start)
+        bot.register_next_step_handler(msg, setting_send_message_segment)
     else:
         bot.reply_to(message, "❌ Неверный выбор.\n/send_message")
 
 
-def send_message_all(message):
-    """Режим: отправить текст ВСЕМ user_id из БД."""
-    text = message.text
+def log_broadcast_error(admin_id, e):
+    """Логирование ошибки одной отправки в рассылке (цикл при этом не прерывается)."""
+    if isinstance(e, ApiTelegramException) and "bot was blocked by the user" in str(e):
+        error_logger.error(f"Ошибка в работе бота из-за: {admin_id}\nError: {e}\n", exc_info=True)
+    else:
+        error_logger.error(f"Ошибка в работе бота через: {admin_id}\nError: {e}\n", exc_info=True)
+
+
+def run_broadcast_job(job):
+    """
+    Выполняет задание рассылки (новое или возобновлённое после падения).
+    kind "message" — текст, иначе тип медиа (document / photo / ...) и его file_id.
+    Ход рассылки показывается в одном сообщении админу, которое редактируется на месте.
+    При BROADCAST_PROCESSES > 1 (или если задание уже было разбито на шарды)
+    рассылка идёт в нескольких процессах.
+    Возвращает JobCheckpoint с итогами.
+    """
+    title = f"📤 Рассылка #{job['id']}"
+    progress = None
+    try:
+        status = bot.send_message(job["chat_id"], f"{title}\n⏳ Запуск...")
+        progress = ProgressReporter(
+            lambda text: bot.edit_message_text(text, chat_id=status.chat.id, message_id=status.message_id),
+            title=title
+        )
+    except Exception as e:
+        # Без сообщения о прогрессе рассылка всё равно должна пройти
+        error_logger.error(f"Ошибка отправки статуса рассылки #{job['id']}\nError: {e}\n", exc_info=True)
+
+    if BROADCAST_PROCESSES > 1 or job_shards(DB_PATH, job["id"]):
+        result = run_sharded(Token, DB_PATH, job, BROADCAST_PROCESSES, broadcaster, progress=progress)
+    else:
+        result = run_job(broadcaster, DB_PATH, job, job_sender(bot, job),
+                         on_error=lambda user_id, e: log_broadcast_error(job["chat_id"], e),
+                         progress=progress)
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT user_id FROM list")
-        user_ids = [row[0] for row in cursor.fetchall()]
+    # Рассылка пометила недоступные чаты в БД — обновляем их список для register_user
+    known_users.load_inactive(DB_PATH)
+    return result
 
-    sent = 0
-    for user_id in user_ids:
+
+def reprobe_loop():
+    """
+    Фоновая перепроверка недоступных чатов раз в STATUS_REPROBE_INTERVAL секунд
+    (каждый чат — всё реже, см. reprobe_recipients). send_chat_action падает, если бот
+    заблокирован, а снова доступному чату на несколько секунд показывает «печатает…».
+    """
+    while True:
+        time.sleep(STATUS_REPROBE_INTERVAL)
         try:
-            bot.send_message(f"{user_id}", f"Сообщение: {text}")
-            sent += 1
-        except telebot.apihelper.ApiTelegramException as e:
-            if "bot was blocked by the user" in str(e):
-                error_logger.error(f"Ошибка в работе бота из-за: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
-            else:
-                error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+            checked, alive = reprobe_recipients(broadcaster, DB_PATH, lambda user_id: bot.send_chat_action(user_id, "typing"),
+                                                older_than=STATUS_REPROBE_INTERVAL)
+            if checked:
+                known_users.load_inactive(DB_PATH)
+                user_logger.info(f"Перепроверка недоступных чатов: проверено {checked}, снова доступны {alive}")
         except Exception as e:
-            error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+            error_logger.error(f"Ошибка перепроверки недоступных чатов\nError: {e}\n", exc_info=True)
+
+
+def resume_broadcast_jobs():
+    """
+    Продолжает незавершённые рассылки с последней контрольной точки.
+    Вызывается один раз при старте процесса (не при каждом перезапуске polling()).
+    """
+    for job in unfinished_jobs(DB_PATH):
+        try:
+            user_logger.info(f"Возобновление рассылки #{job['id']} после user_id {job['cursor']}")
+            result = run_broadcast_job(job)
+            bot.send_message(job["chat_id"], f"✅ Рассылка #{job['id']} возобновлена и завершена. Было отправлено: {result.sent}.", reply_markup=start)
+        except Exception as e:
+            error_logger.error(f"Ошибка возобновления рассылки #{job['id']}\nError: {e}\n", exc_info=True)
+
+
+def send_message_all(message, segment=None):
+    """Режим: отправить текст ВСЕМ user_id из БД (или только сегменту — tags.id)."""
+    text = message.text
+
+    job = create_job(DB_PATH, "message", text, message.chat.id, segment=segment)
+    result = run_broadcast_job(job)
+    stats = result.stats
+    user_logger.info(f"Рассылка сообщения #{job['id']}: отправлено {result.sent}, ошибок {result.failed}, недоступны {result.blocked}, повторов после 429: {stats.retried}, {stats.rate:.1f} сообщ./с")
+
+    bot.send_message(message.chat.id, f"✅ Сообщение: {text}. Было отправлено: {result.sent}.\n🚫 Недоступны (пропущены в следующий раз): {result.blocked}.\n⚡ Скорость: {stats.rate:.1f} сообщ./с", reply_markup=start)
+
 
-    bot.send_message(message.chat.id, f"✅ Сообщение: {text}. Было отправлено: {sent}.", reply_markup=start)
+def setting_send_message_segment(message):
+    """Тег введён — ждём текст для рассылки его участникам."""
+    segment = repo.tag_id(message.text.strip())
+
+    if segment is None:
+        bot.reply_to(message, "❔ Такого тега нет.\n/send_message")
+    else:
+        bot.send_message(message.chat.id, "Введите сообщение, которое хотите отправить сегменту:")
+        bot.register_next_step_handler(message, send_message_all, segment)
 
 
 def setting_send_message_id(message):
@@ -680,9 +1072,13 @@ def setting_send_message_text(message, user_id):
     text = message.text
 
     try:
-        bot.send_message(user_id, f"Сообщение: {text}")
+        # Через общий слой отправки: лимит скорости и повтор после 429
+        broadcaster.send(lambda: bot.send_message(user_id, f"Сообщение: {text}"))
         bot.send_message(message.chat.id, f"✅ Сообщение: {text}\nБыл отправлен пользователю с ID: {user_id}", reply_markup=start)
     except telebot.apihelper.ApiTelegramException as e:
+        # Недоступный чат помечаем, чтобы массовые рассылки его пропускали
+        if mark_recipient(DB_PATH, user_id, e):
+            known_users.set_inactive(user_id)
         if "bot was blocked by the user" in str(e):
             error_logger.error(f"Ошибка в работе бота из-за:: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
             bot.reply_to(message, f"❌ Пользователь заблокировал бота: {user_id}\n/send_message")
@@ -699,10 +1095,11 @@ def setting_send_message_text(message, user_id):
 # -----------------------
 @bot.message_handler(commands=['send_file'])
 def setting_send_file(message):
-    """Выбор отправки файла — всем или по ID."""
+    """Выбор отправки файла — всем, по ID или сегменту (тегу)."""
     bot.reply_to(message, "Выберите критерий для отправки файла:\n"
                           "1 - Отправить всем.\n"
-                          "2 - Отправить по ID.\n", reply_markup=variant)
+                          "2 - Отправить по ID.\n"
+                          "3 - Отправить сегменту (по тегу).\n", reply_markup=send_variant)
     bot.register_next_step_handler(message, variant_send_file)
 
 
@@ -711,44 +1108,71 @@ def variant_send_file(message):
     variant_choice = message.text
 
     if variant_choice == "1":
-        bot.send_message(message.chat.id, "Сбросьте файл, который хотите отправить всем:")
+        bot.send_message(message.chat.id, "Сбросьте файл (документ, фото, видео, аудио) или пришлите путь / URL, который хотите отправить всем:")
         bot.register_next_step_handler(message, send_file_all)
     elif variant_choice == "2":
         bot.send_message(message.chat.id, "Все записаны ID:")
         send_paginated_list(message.chat.id)
         msg = bot.send_message(message.chat.id, "Введите user ID кому хотите отправить файл:", reply_markup=start)
         bot.register_next_step_handler(msg, setting_send_file_id)
+    elif variant_choice == "3":
+        bot.send_message(message.chat.id, format_tags_text())
+        msg = bot.send_message(message.chat.id, "Введите тег, участникам которого отправить файл:", reply_markup=start)
+        bot.register_next_step_handler(msg, setting_send_file_segment)
     else:
         bot.reply_to(message, "❌ Неверный выбор.\n/send_file")
 
 
-def send_file_all(message):
-    """Отправляет присланный файл всем пользователям в БД."""
-    file = message.document
+def resolve_file(message):
+    """
+    Файл для /send_file: вложение (документ, фото, видео, аудио, голосовое, анимация)
+    или путь к локальному файлу в SEND_FILE_DIR / URL в тексте. Локальные файлы и URL загружаются
+    один раз, дальше — по file_id из кэша (file_cache.py).
+    Возвращает (kind, file_id) или None, если файла в сообщении нет.
+    """
+    media = media_from_message(message)
+    if media:
+        return media
+
+    source = file_source(message.text, SEND_FILE_DIR)
+    if source:
+        kind, file_id, cached = upload_once(bot, DB_PATH, source, message.chat.id)
+        user_logger.info(f"Файл {source}: {'file_id из кэша' if cached else 'загружен'} ({kind})")
+        return kind, file_id
+    return None
+
+
+def send_file_all(message, segment=None):
+    """Отправляет присланный файл всем пользователям в БД (или только сегменту — tags.id)."""
+    try:
+        file = resolve_file(message)
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, "❌ Не удалось загрузить файл.\n/send_file")
+        return
 
     if file is None:
         bot.reply_to(message, "❌ Не получен файл отправьте файл.\n/send_file")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT user_id FROM list")
-        user_ids = [row[0] for row in cursor.fetchall()]
+    kind, file_id = file
+    job = create_job(DB_PATH, kind, file_id, message.chat.id, segment=segment)
+    result = run_broadcast_job(job)
+    stats = result.stats
+    user_logger.info(f"Рассылка файла #{job['id']}: отправлено {result.sent}, ошибок {result.failed}, недоступны {result.blocked}, повторов после 429: {stats.retried}, {stats.rate:.1f} сообщ./с")
+
+    bot.send_message(message.chat.id, f"✅ Файл был послан: {result.sent} пользователям.\n🚫 Недоступны (пропущены в следующий раз): {result.blocked}.\n⚡ Скорость: {stats.rate:.1f} сообщ./с", reply_markup=start)
 
-    sent = 0
-    for user_id in user_ids:
-        try:
-            bot.send_document(user_id, file.file_id)
-            sent += 1
-        except telebot.apihelper.ApiTelegramException as e:
-            if "bot was blocked by the user" in str(e):
-                error_logger.error(f"Ошибка в работе бота из-за: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
-            else:
-                error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
-        except Exception as e:
-            error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
 
-    bot.send_message(message.chat.id, f"✅ Файл был послан: {sent} пользователям.", reply_markup=start)
+def setting_send_file_segment(message):
+    """Тег введён — ждём файл для рассылки его участникам."""
+    segment = repo.tag_id(message.text.strip())
+
+    if segment is None:
+        bot.reply_to(message, "❔ Такого тега нет.\n/send_file")
+    else:
+        bot.send_message(message.chat.id, "Сбросьте файл (документ, фото, видео, аудио) или пришлите путь / URL, который хотите отправить сегменту:")
+        bot.register_next_step_handler(message, send_file_all, segment)
 
 
 def setting_send_file_id(message):
@@ -758,22 +1182,31 @@ def setting_send_file_id(message):
     if not user_id.isdigit():
         bot.reply_to(message, "❌ Введите ID в формате (цифры).\n/send_file")
     else:
-        bot.send_message(message.chat.id, "Сбросьте файл, который хотите отправить:")
+        bot.send_message(message.chat.id, "Сбросьте файл (документ, фото, видео, аудио) или пришлите путь / URL, который хотите отправить:")
         bot.register_next_step_handler(message, setting_send_file_file, int(user_id))
 
 
 def setting_send_file_file(message, user_id):
     """Отправляем файл указанному ID."""
-    file = message.document
+    try:
+        file = resolve_file(message)
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, "❌ Не удалось загрузить файл.\n/send_file")
+        return
 
     if file is None:
         bot.reply_to(message, "❌ Не получен файл отправьте файл.\n/send_file")
         return
 
+    kind, file_id = file
     try:
-        bot.send_document(user_id, file.file_id)
+        broadcaster.send(lambda: send_media(bot, kind, user_id, file_id))
         bot.send_message(message.chat.id, f"✅ Файл был отправлен пользователю с ID: {user_id}", reply_markup=start)
     except telebot.apihelper.ApiTelegramException as e:
+        # Недоступный чат помечаем, чтобы массовые рассылки его пропускали
+        if mark_recipient(DB_PATH, user_id, e):
+            known_users.set_inactive(user_id)
         if "bot was blocked by the user" in str(e):
             error_logger.error(f"Ошибка в работе бота из-за: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
             bot.reply_to(message, f"❌ Пользователь заблокировал бота: {user_id}\n/send_file")
@@ -804,12 +1237,7 @@ def setting_replace(message):
         bot.reply_to(message, "❌ Введите Number в формате (цифры).\n/replace_name")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
+    if repo.exists(id):
         bot.send_message(message.chat.id, "Введите новый Name:")
         bot.register_next_step_handler(message, replace_name, id)
     else:
@@ -821,10 +1249,7 @@ def replace_name(message, id):
     name = message.text.strip()
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET name = ? WHERE id = ?", (name, id))
-            db.commit()
+        repo.update(id, "name", name)
 
         bot.send_message(message.chat.id, f"✅ Name успешно обновлен для Number {id}.", reply_markup=start)
     except Exception as e:
@@ -848,12 +1273,7 @@ def setting_replace_user(message):
         bot.reply_to(message, "❌ Введите Number (цифры).\n/replace_user")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
+    if repo.exists(id):
         bot.send_message(message.chat.id, "Введите новый @User:")
         bot.register_next_step_handler(message, replace_user, id)
     else:
@@ -869,10 +1289,7 @@ def replace_user(message, id):
         return
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET user = ? WHERE id = ?", (user, id))
-            db.commit()
+        repo.update(id, "user", user)
 
         bot.send_message(message.chat.id, f"✅ User обновлен для Number {id}", reply_markup=start)
     except Exception as e:
@@ -896,13 +1313,8 @@ def setting_replace_tag(message):
         bot.reply_to(message, "❌ Введите Number (цифры).\n/replace_tag")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
-        bot.send_message(message.chat.id, "Введите новый Tag) или - если удалить:")
+    if repo.exists(id):
+        bot.send_message(message.chat.id, "Введите новый Tag (несколько — через запятую) или - если удалить:")
         bot.register_next_step_handler(message, replace_tag, id)
     else:
         bot.reply_to(message, "❔ Такого Number нет.\n/replace_tag")
@@ -914,10 +1326,7 @@ def replace_tag(message, id):
     if tag == "-":
         tag = ""
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET tag = ? WHERE id = ?", (tag, id))
-            db.commit()
+        repo.update(id, "tag", tag)
 
         bot.send_message(message.chat.id, f"✅ Tag обновлён для Number {id}", reply_markup=start)
     except Exception as e:
@@ -941,12 +1350,7 @@ def setting_replace_email(message):
         bot.reply_to(message, "❌ Введите Number (цифры).\n/replace_email")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
+    if repo.exists(id):
         bot.send_message(message.chat.id, "Введите новый Email или - если удалить:")
         bot.register_next_step_handler(message, replace_email, id)
     else:
@@ -960,10 +1364,7 @@ def replace_email(message, id):
         email = ""
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET email = ? WHERE id = ?", (email, id))
-            db.commit()
+        repo.update(id, "email", email)
 
         bot.send_message(message.chat.id, f"✅ Email обновлён для Number {id}", reply_markup=start)
     except Exception as e:
@@ -987,12 +1388,7 @@ def setting_replace_instagram(message):
         bot.reply_to(message, "❌ Введите Number (цифры).\n/replace_instagram")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
+    if repo.exists(id):
         bot.send_message(message.chat.id, "Введите новый Instagram или - если удалить:")
         bot.register_next_step_handler(message, replace_instagram, id)
     else:
@@ -1006,10 +1402,7 @@ def replace_instagram(message, id):
         instagram = ""
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET instagram = ? WHERE id = ?", (instagram, id))
-            db.commit()
+        repo.update(id, "instagram", instagram)
 
         bot.send_message(message.chat.id, f"✅ Instagram обновлён для Number {id}", reply_markup=start)
     except Exception as e:
@@ -1033,12 +1426,7 @@ def setting_replace_tiktok(message):
         bot.reply_to(message, "❌ Введите Number (цифры).\n/replace_tiktok")
         return
 
-    with sqlite3.connect(DB_PATH) as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM list WHERE id = ?", (id,))
-        result = cursor.fetchone()
-
-    if result:
+    if repo.exists(id):
         bot.send_message(message.chat.id, "Введите новый Tiktok или - если удалить:")
         bot.register_next_step_handler(message, replace_tiktok, id)
     else:
@@ -1052,10 +1440,7 @@ def replace_tiktok(message, id):
         tiktok = ""
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("UPDATE list SET tiktok = ? WHERE id = ?", (tiktok, id))
-            db.commit()
+        repo.update(id, "tiktok", tiktok)
 
         bot.send_message(message.chat.id, f"✅ Tiktok обновлён для Number {id}", reply_markup=start)
     except Exception as e:
@@ -1100,10 +1485,8 @@ def clear_db(message):
         return
 
     try:
-        with sqlite3.connect(DB_PATH) as db:
-            cursor = db.cursor()
-            cursor.execute("DELETE FROM list")
-            db.commit()
+        repo.clear()
+        known_users.clear()
 
         bot.reply_to(message, "✅ Вся база данных была очищена.", reply_markup=start)
     except Exception as e:
@@ -1111,13 +1494,269 @@ def clear_db(message):
         bot.reply_to(message, f"❌ Ошибка\n/clear_db")
 
 
+# -----------------------
+# Теги-сегменты (/tag)
+# -----------------------
+def format_tags_text():
+    """Список тегов с числом записей (для /tag и выбора сегмента рассылки)."""
+    tags = repo.tags()
+    if not tags:
+        return "❔ Тегов нет."
+    return "🏷 Теги:\n" + "\n".join(f"{name} — {count}" for name, count in tags)
+
+
+@bot.message_handler(commands=['tag'])
+def tag_cmd(message):
+    """Выбор действия с тегами."""
+    bot.reply_to(message, "Выберите действие с тегами:\n"
+                          "1 - Список тегов.\n"
+                          "2 - Добавить тег записи.\n"
+                          "3 - Убрать тег у записи.\n"
+                          "4 - Удалить тег.\n", reply_markup=tag_variant)
+    bot.register_next_step_handler(message, tag_action)
+
+
+def tag_action(message):
+    """Обработка выбора действия /tag."""
+    variant_choice = message.text
+
+    if variant_choice == "1":
+        bot.send_message(message.chat.id, format_tags_text(), reply_markup=start)
+    elif variant_choice in ("2", "3"):
+        send_paginated_list(message.chat.id)
+        msg = bot.send_message(message.chat.id, "Введите Number записи:")
+        bot.register_next_step_handler(msg, tag_entry, variant_choice == "2")
+    elif variant_choice == "4":
+        bot.send_message(message.chat.id, format_tags_text())
+        msg = bot.send_message(message.chat.id, "Введите тег, который удалить у всех записей:")
+        bot.register_next_step_handler(msg, tag_drop)
+    else:
+        bot.reply_to(message, "❌ Неверный выбор.\n/tag")
+
+
+def tag_entry(message, add):
+    """Проверка Number и запрос тега."""
+    id = message.text.strip()
+
+    if not id.isdigit():
+        bot.reply_to(message, "❌ Введите Number (цифры).\n/tag")
+        return
+
+    if repo.exists(id):
+        bot.send_message(message.chat.id, "Введите тег:")
+        bot.register_next_step_handler(message, tag_apply, id, add)
+    else:
+        bot.reply_to(message, "❔ Такого Number нет.\n/tag")
+
+
+def tag_apply(message, id, add):
+    """Добавление / удаление связи записи с тегом."""
+    name = message.text.strip()
+    if split_tags(name) != [name]:
+        bot.reply_to(message, "❌ Тег не может быть пустым, \"-\" или содержать запятую.\n/tag")
+        return
+
+    try:
+        if add:
+            changed = repo.add_tag(id, name)
+            text = f"✅ Тег {name} добавлен записи {id}." if changed else f"❔ У записи {id} уже есть тег {name}."
+        else:
+            changed = repo.remove_tag(id, name)
+            text = f"✅ Тег {name} убран у записи {id}." if changed else f"❔ У записи {id} нет тега {name}."
+        bot.send_message(message.chat.id, text, reply_markup=start)
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, f"❌ Ошибка\n/tag")
+
+
+def tag_drop(message):
+    """Удаление тега целиком (записи остаются)."""
+    name = message.text.strip()
+
+    try:
+        linked = repo.drop_tag(name)
+        if linked is None:
+            bot.reply_to(message, "❔ Такого тега нет.\n/tag")
+        else:
+            bot.send_message(message.chat.id, f"✅ Тег {name} удалён (был у {linked} записей).", reply_markup=start)
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, f"❌ Ошибка\n/tag")
+
+
+# -----------------------
+# Массовый импорт (/import)
+# -----------------------
+@bot.message_handler(commands=['import'])
+def import_cmd(message):
+    """Запрос файла для массового импорта пользователей (только админ)."""
+    if int(message.from_user.id) != ADMIN:
+        bot.reply_to(message, "❌ Вы не являетесь администратором и не можете использовать эту команду.", reply_markup=start)
+        return
+
+    msg = bot.send_message(message.chat.id, "Отправьте документом CSV (с заголовком) или JSONL, можно .gz.\n"
+                                            "Колонки: user_id, user, name, tag, phone, email, instagram, tiktok")
+    bot.register_next_step_handler(msg, process_import)
+
+
+def process_import(message):
+    """Потоковый разбор присланного файла и запись пачками (transfer.py)."""
+    document = getattr(message, "document", None)
+    if not document:
+        bot.reply_to(message, "❌ Файл не получен, отправьте его документом.\n/import")
+        return
+
+    file_name = document.file_name or ""
+    fmt = file_format(file_name)
+    if not fmt:
+        bot.reply_to(message, "❌ Поддерживаются .csv, .jsonl (и они же в .gz).\n/import")
+        return
+
+    try:
+        data = bot.download_file(bot.get_file(document.file_id).file_path)
+        result = import_records(repo, read_records(open_text(file_name, data), fmt),
+                                chunk_rows=IMPORT_CHUNK_ROWS, known=known_users)
+    except Exception as e:
+        error_logger.error(f"Ошибка в работе бота через: {getattr(message.from_user,'id','unknown')}\nError: {e}\n", exc_info=True)
+        bot.reply_to(message, "❌ Ошибка импорта\n/import")
+        return
+
+    user_logger.info(f"Импорт {file_name}: строк {result['rows']}, добавлено {result['inserted']}, обновлено {result['updated']}, "
+                     f"отклонено {result['rejected']}, {result['seconds']:.1f} с")
+    bot.send_message(message.chat.id, format_report(result), reply_markup=start)
+
+
+# -----------------------
+# Выгрузка (/export)
+# -----------------------
+# Выбор фильтра /export -> (поле list, название для вопроса)
+EXPORT_FIELDS = {"1": ("user", "User"), "2": ("name", "Name"), "3": ("tag", "Tag"), "4": ("email", "Email"),
+                 "5": ("instagram", "Instagram"), "6": ("tiktok", "TikTok")}
+
+
+@bot.message_handler(commands=['export'])
+def export_cmd(message):
+    """Выбор формата выгрузки (только админ)."""
+    if int(message.from_user.id) != ADMIN:
+        bot.reply_to(message, "❌ Вы не являетесь администратором и не можете использовать эту команду.", reply_markup=start)
+        return
+
+    bot.reply_to(message, "Выберите формат файла (сжатый gzip):\n"
+                          "1 - CSV.\n"
+                          "2 - JSONL.\n", reply_markup=variant)
+    bot.register_next_step_handler(message, export_format)
+
+
+def export_format(message):
+    """Формат выбран — спрашиваем, что выгрузить."""
+    fmt = {"1": "csv", "2": "jsonl"}.get(message.text)
+    if not fmt:
+        bot.reply_to(message, "❌ Неверный выбор.\n/export")
+        return
+
+    bot.reply_to(message, "Что выгрузить (фильтр без учёта регистра, как в /view):\n"
+                          "0 - Все записи.\n"
+                          "1 - По User.\n"
+                          "2 - По Name.\n"
+                          "3 - По Tag.\n"
+                          "4 - По Email.\n"
+                          "5 - По Instagram.\n"
+                          "6 - По TikTok.\n", reply_markup=export_variant)
+    bot.register_next_step_handler(message, export_filter, fmt)
+
+
+def export_filter(message, fmt):
+    """Все записи — сразу в выгрузку, иначе спрашиваем значение фильтра."""
+    if message.text == "0":
+        start_export(message, fmt)
+    elif message.text in EXPORT_FIELDS:
+        field, title = EXPORT_FIELDS[message.text]
+        msg = bot.send_message(message.chat.id, f"Введите {title} для выгрузки записей:")
+        bot.register_next_step_handler(msg, process_export_value, fmt, field)
+    else:
+        bot.reply_to(message, "❌ Неверный выбор.\n/export")
+
+
+def process_export_value(message, fmt, field):
+    """Значение фильтра введено — запускаем выгрузку."""
+    start_export(message, fmt, field, message.text.strip())
+
+
+def start_export(message, fmt, where=None, where_val=None):
+    """Выгрузка идёт в отдельном потоке: хендлеры и polling не ждут её окончания."""
+    bot.send_message(message.chat.id, "⏳ Выгрузка началась, файл придёт отдельным сообщением.", reply_markup=start)
+    threading.Thread(target=run_export, args=(message.chat.id, fmt, where, where_val), daemon=True).start()
+
+
+def run_export(chat_id, fmt, where=None, where_val=None):
+    """Пишет list (или его фильтр) во временный .gz файл потоком и отправляет его документом."""
+    started = time.perf_counter()
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        rows = repo.scan(where, where_val, batch_rows=EXPORT_BATCH_ROWS)
+        count = export_rows(rows, repo.columns, fmt, path)
+        size = os.path.getsize(path)
+        seconds = time.perf_counter() - started
+        user_logger.info(f"Выгрузка {fmt}{f' ({where} = {where_val})' if where else ''}: {count} записей, "
+                         f"{size / 1024 / 1024:.1f} МБ, {seconds:.1f} с")
+        with open(path, "rb") as document:
+            bot.send_document(chat_id, document, visible_file_name=f"export_{stamp}.{fmt}.gz",
+                              caption=f"📦 Записей: {count}, {size / 1024 / 1024:.1f} МБ, {seconds:.1f} с")
+    except Exception as e:
+        error_logger.error(f"Ошибка выгрузки: {e}", exc_info=True)
+        try:
+            bot.send_message(chat_id, "❌ Ошибка выгрузки\n/export", reply_markup=start)
+        except:
+            pass
+    finally:
+        os.remove(path)
+
+
+# -----------------------
+# Метрики БД
+# -----------------------
+@bot.message_handler(commands=['db_stats'])
+def db_stats(message):
+    """Метрики пула соединений с БД (только админ)."""
+    if int(message.from_user.id) != ADMIN:
+        bot.reply_to(message, "❌ Вы не являетесь администратором и не можете использовать эту команду.", reply_markup=start)
+        return
+
+    stats = db_pool.stats()
+    bot.reply_to(message, f"🗄 Пул соединений: открыто {stats['open']} из {stats['size']}, свободно {stats['idle']}, журнал: {stats['journal_mode']}\n"
+                          f"Из пула: {stats['hits']}, новых: {stats['misses']} (попаданий {stats['hit_ratio']:.1%})\n"
+                          f"Ожиданий свободного: {stats['waits']}, всего {stats['wait_time']:.2f} с\n"
+                          f"📄 Кэш страниц: {len(page_cache)} из {page_cache.maxsize}, попаданий {page_cache.hits}, промахов {page_cache.misses}\n"
+                          f"🔢 Кэш подсчётов: {len(count_cache)} из {count_cache.maxsize}, попаданий {count_cache.hits}, промахов {count_cache.misses}"
+                          + "".join(f"\n⏱ {name}: {calls} выз., всего {total * 1000:.0f} мс, макс. {worst * 1000:.1f} мс"
+                                    for name, calls, total, worst in repo.stats()[:DB_STATS_TOP]), reply_markup=start)
+
+
 # -----------------------
 # Запуск polling()
 # -----------------------
 if __name__ == "__main__":
+    start_runtime()
+
+    # SIGTERM (systemd / docker stop) — обычный выход, чтобы atexit дописал буфер регистраций
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Незавершённые рассылки продолжаем в фоне, чтобы не задерживать polling()
+    threading.Thread(target=resume_broadcast_jobs, daemon=True).start()
+    threading.Thread(target=reprobe_loop, daemon=True).start()
+
+    if BOT_RUNTIME == "async":
+        # Импорт здесь: для asyncio-режима нужен aiohttp, в обычном режиме он не обязателен
+        from async_runtime import run_async_bot
+
     while True:
         try:
             print("🤖 Бот запущен...")
+            if BOT_RUNTIME == "async":
+                run_async_bot(Token, bot, ADMIN, register_user)
+                continue
             bot.polling(timeout=60, long_polling_timeout=60)
         except Exception as e:
             # Пытаемся уведомить админа, логируем и продолжаем попытки перезапуска
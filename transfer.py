@@ -0,0 +1,225 @@
+#
+# CraftCore Launcher
+# Copyright (C) 2026 pexa6
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+
+"""
+Массовый импорт и выгрузка пользователей list (/import и /export в bot.py и secondary.py).
+
+Файл — CSV с заголовком или JSONL (по объекту на строку), можно сжатый .gz.
+Ключи — имена колонок list: user_id и поля бота (user, name, tag, phone, ...),
+лишние игнорируются. Файл читается потоком, строка за строкой, проверяется
+теми же правилами, что и диалог /add (valid_user / valid_phone / valid_email;
+пустой user допустим — так хранятся пользователи без username),
+и пишется пачками по chunk_rows строк: одна транзакция executemany на пачку
+(ListRepository.upsert_many).
+
+Выгрузка — обратный путь: строки из ListRepository.scan по одной пишутся в
+gzip-сжатый CSV или JSONL, в памяти не копятся. Такой файл можно снова
+загрузить через /import.
+"""
+
+import csv
+import gzip
+import io
+import json
+import time
+
+
+# Символы, допустимые в @User (как в write_user)
+USER_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+
+# Поля, которые в /add можно пропустить ответом "-"
+SKIPPABLE = ("tag", "phone", "email", "instagram", "tiktok")
+
+# Наибольший ID, который помещается в INTEGER SQLite (64 бита со знаком)
+MAX_USER_ID = 2 ** 63 - 1
+
+# Сколько отклонённых строк перечислять в отчёте
+MAX_REPORTED_ERRORS = 10
+
+# Уровень сжатия выгрузки: 6 почти не уступает 9 в размере, но заметно быстрее
+EXPORT_GZIP_LEVEL = 6
+
+
+# -----------------------
+# Правила проверки (общие с диалогом /add)
+# -----------------------
+def valid_user(user):
+    """@User: начинается с @, дальше латиница, цифры и _."""
+    return user.startswith('@') and len(user) > 1 and all(char in USER_CHARS for char in user[1:])
+
+
+def valid_phone(phone):
+    """Телефон в формате +380XXXXXXXXX."""
+    return phone.startswith('+') and len(phone) > 1 and phone[1:].isdigit()
+
+
+def valid_email(email):
+    """Email в самом простом виде: есть @ и точка."""
+    return "@" in email and "." in email and len(email) > 3
+
+
+CHECKS = {
+    "user": (valid_user, "User должен быть в формате @User"),
+    "phone": (valid_phone, "телефон должен быть в формате +380XXXXXXXXX"),
+    "email": (valid_email, "некорректный email"),
+}
+
+
+def clean_record(record, fields):
+    """
+    Кортеж (user_id, *fields) для upsert из словаря record.
+    Ошибка проверки — ValueError с причиной.
+    """
+    user_id = str(record.get("user_id") or "").strip()
+    if not user_id.isdecimal():
+        raise ValueError("ID должен состоять из цифр")
+    user_id = int(user_id)
+    # Больше INTEGER SQLite sqlite3 не передаст: OverflowError сорвал бы всю пачку executemany
+    if not 0 < user_id <= MAX_USER_ID:
+        raise ValueError("ID вне допустимого диапазона")
+
+    values = [user_id]
+    for field in fields:
+        value = str(record.get(field) or "").strip()
+        if field in SKIPPABLE and value == "-":
+            value = ""
+        check = CHECKS.get(field)
+        # Проверяются только заполненные поля: пользователи без username (register_user)
+        # хранятся с пустым user, и выгрузка с ними должна загружаться обратно
+        if check and value and not check[0](value):
+            raise ValueError(check[1])
+        values.append(value)
+    return tuple(values)
+
+
+# -----------------------
+# Чтение файла
+# -----------------------
+def open_text(file_name, data):
+    """Текстовый поток из содержимого файла (gzip — по расширению .gz)."""
+    raw = io.BytesIO(data)
+    if file_name.lower().endswith(".gz"):
+        raw = gzip.GzipFile(fileobj=raw)
+    # utf-8-sig: Excel сохраняет CSV с BOM
+    return io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+
+def file_format(file_name):
+    """"csv", "jsonl" или None по расширению имени файла."""
+    name = file_name.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    return None
+
+
+def read_records(stream, fmt):
+    """
+    Генератор (номер строки, dict или ValueError) по потоку stream.
+    Весь файл в память не разбирается — по строке за раз.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, ValueError("строка не является JSON")
+            continue
+        yield number, record if isinstance(record, dict) else ValueError("ожидается JSON-объект")
+
+
+# -----------------------
+# Импорт
+# -----------------------
+def import_records(repo, records, chunk_rows=5000, known=None):
+    """
+    Проверяет записи и пишет их пачками по chunk_rows (repo.upsert_many).
+    known — KnownUsers: добавленные user_id сразу попадают в индекс в памяти.
+    Возвращает dict: inserted, updated, unchanged, rejected, errors [(строка, причина)], rows, seconds.
+    """
+    result = {"inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0, "errors": [], "rows": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    chunk = []
+
+    def flush():
+        inserted, updated = repo.upsert_many(chunk)
+        result["inserted"] += inserted
+        result["updated"] += updated
+        result["unchanged"] += len(chunk) - inserted - updated
+        if known is not None:
+            for row in chunk:
+                known.add(row[0])
+        chunk.clear()
+
+    for number, record in records:
+        result["rows"] += 1
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            chunk.append(clean_record(record, repo.fields))
+        except ValueError as e:
+            result["rejected"] += 1
+            if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                result["errors"].append((number, str(e)))
+            continue
+        if len(chunk) >= chunk_rows:
+            flush()
+    if chunk:
+        flush()
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def format_report(result):
+    """Текст отчёта /import."""
+    rate = result["rows"] / result["seconds"] if result["seconds"] else 0
+    text = (f"✅ Импорт завершён: {result['rows']} строк за {result['seconds']:.1f} с ({rate:.0f} строк/с)\n"
+            f"➕ Добавлено: {result['inserted']}\n"
+            f"✏️ Обновлено: {result['updated']}\n"
+            f"➖ Без изменений: {result['unchanged']}\n"
+            f"🚫 Отклонено: {result['rejected']}")
+    if result["errors"]:
+        text += "\n\n" + "\n".join(f"Строка {number}: {reason}" for number, reason in result["errors"])
+        if result["rejected"] > len(result["errors"]):
+            text += f"\n… и ещё {result['rejected'] - len(result['errors'])}"
+    return text
+
+
+# -----------------------
+# Выгрузка
+# -----------------------
+def export_rows(rows, columns, fmt, path):
+    """
+    Пишет rows (кортежи columns) в path: gzip-сжатый CSV с заголовком или JSONL (fmt).
+    Память не зависит от числа строк. Возвращает, сколько строк записано.
+    """
+    count = 0
+    with gzip.open(path, "wt", compresslevel=EXPORT_GZIP_LEVEL, encoding="utf-8", newline="") as out:
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                count += 1
+    return count